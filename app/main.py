@@ -1,11 +1,8 @@
 import os
 import sys
-import json
-import uuid
-import re
+import errno
+import secrets
 import shutil
-import tempfile
-import subprocess
 from datetime import datetime
 from pathlib import Path
 from flask import Flask, request, jsonify, send_file
@@ -46,12 +43,13 @@ app.config['PROCESSED_FOLDER'] = PROCESSED_FOLDER
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {
-    'excel': {'xlsx', 'xls', 'xlsm'},
-    'pdf': {'pdf'}
+    'excel': frozenset({'.xlsx', '.xls', '.xlsm'}),
+    'pdf': frozenset({'.pdf'})
 }
 
 def allowed_file(filename, file_type):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS.get(file_type, set())
+    # Only the extension is lowered, not the whole name
+    return os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS.get(file_type, frozenset())
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -74,9 +72,8 @@ def upload_and_process():
         combine_invoices = request.form.get('combineInvoices', 'false').lower() == 'true'
         existing_file_path = request.form.get('existingFilePath', '')
         
-        # Save uploaded files to temp directory
+        # Save uploaded files to temp directory (created at startup)
         temp_dir = app.config['UPLOAD_FOLDER']
-        os.makedirs(temp_dir, exist_ok=True)
         
         coa_filename = secure_filename(coa_file.filename)
         invoice_filename = secure_filename(invoice_file.filename)
@@ -89,80 +86,40 @@ def upload_and_process():
         
         app.logger.info(f"Files saved: {coa_file_path}, {invoice_file_path}")
         
-        # Process the invoice using perfect4.py directly
-        # Build the command based on the parameters
-        script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'perfect4.py')
-        
-        # Prepare command arguments
-        cmd = ['python', script_path, coa_file_path, invoice_file_path]
-        
-        # Add sheet name if provided
-        if sheet_name:
-            cmd.append(sheet_name)
-            
-        # Add existing file path if combining invoices
-        if combine_invoices and existing_file_path:
-            cmd.append(existing_file_path)
-            
-        app.logger.info(f"Running command: {' '.join(cmd)}")
-        
-        # Create a temporary file to capture the output
-        output_file = tempfile.NamedTemporaryFile(delete=False, suffix='.txt')
-        output_file_path = output_file.name
-        output_file.close()
-        
-        # Run the process and capture output
-        process = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=False  # Don't raise exception on non-zero return code
+        # Process the invoice in this process; perfect4 returns the output path
+        processed_file_path = perfect4.process(
+            coa_file_path,
+            [invoice_file_path],
+            sheet_name or None,
+            existing_file_path if combine_invoices and existing_file_path else None
         )
         
-        # Save stdout to the temp file for debugging
-        with open(output_file_path, 'w') as f:
-            f.write(process.stdout)
-            
-        if process.returncode != 0:
-            app.logger.error(f"Error running perfect4.py: {process.stderr}")
-            return jsonify({'error': f"Script execution failed: {process.stderr}"}), 500
-            
-        # Try to extract the output file path from the script output
-        output_text = process.stdout
-        processed_file_path = None
-        
-        # Look for various patterns that might indicate the output file path
-        for line in output_text.splitlines():
-            if 'Saved to:' in line or 'saved at:' in line or 'saved to:' in line:
-                processed_file_path = line.split(':', 1)[1].strip()
-                break
-                
-        if not processed_file_path:
-            # Try to find any path-like string in the output
-            import re
-            path_match = re.search(r'[a-zA-Z]:\\(?:[^\\/:*?"<>|\r\n]+\\)*[^\\/:*?"<>|\r\n]*\.xlsx', output_text)
-            if path_match:
-                processed_file_path = path_match.group(0)
-        
-        if not processed_file_path or not os.path.exists(processed_file_path):
-            app.logger.error(f"Could not find output file in script output")
-            return jsonify({
-                'error': 'Could not determine output file path',
-                'script_output': output_text
-            }), 500
-            
         # Move the file to the processed folder for storage
         processed_dir = app.config['PROCESSED_FOLDER']
-        os.makedirs(processed_dir, exist_ok=True)
         
-        # Generate a unique filename to avoid collisions
+        # Generate a unique filename to avoid collisions; a timestamp prefix
+        # collided for uploads finishing in the same second
         filename = os.path.basename(processed_file_path)
-        unique_filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
+        unique_filename = f"{secrets.token_hex(6)}_{filename}"
         stored_file_path = os.path.join(processed_dir, unique_filename)
         
-        # Copy the file to the processed directory
-        import shutil
-        shutil.copy2(processed_file_path, stored_file_path)
+        # Both need no data copy as long as the folders share a filesystem.
+        # A fresh output is renamed into the processed directory; when combining,
+        # the output is the existing file, which stays in place and is hard-linked
+        appended_in_place = bool(existing_file_path) and \
+            os.path.abspath(processed_file_path) == os.path.abspath(existing_file_path)
+        try:
+            if appended_in_place:
+                os.link(processed_file_path, stored_file_path)
+            else:
+                os.replace(processed_file_path, stored_file_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            if appended_in_place:
+                shutil.copy2(processed_file_path, stored_file_path)
+            else:
+                shutil.move(processed_file_path, stored_file_path)
         
         # Create download URL
         download_url = f"/api/download-file/{unique_filename}"
@@ -170,7 +127,6 @@ def upload_and_process():
         return jsonify({
             'success': True,
             'message': 'Invoice processed successfully',
-            'script_output': output_text,
             'file_info': {
                 'path': stored_file_path,
                 'filename': unique_filename,
@@ -199,39 +155,13 @@ def get_excel_sheets_endpoint():
         file_path = os.path.join(app.config['TEMP_FOLDER'], filename)
         file.save(file_path)
         
-        # Use the get_excel_sheets.py script to get sheet names
+        # Read the sheet names in this process with get_excel_sheets.py
         try:
-            # We can either use direct import or subprocess
-            # Using direct import
-            sheets = get_excel_sheets.get_sheets(file_path)
+            sheets = get_excel_sheets.read_sheet_names(file_path)
             return jsonify({"success": True, "sheets": sheets})
         except Exception as e:
-            app.logger.error(f"Error with direct import: {str(e)}")
-            
-            # Fallback to subprocess if direct import fails
-            try:
-                script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'get_excel_sheets.py')
-                process = subprocess.run(
-                    ['python', script_path, file_path],
-                    capture_output=True,
-                    text=True,
-                    check=False
-                )
-                
-                if process.returncode != 0:
-                    return jsonify({"error": f"Error getting sheets: {process.stderr}"}), 500
-                    
-                # Try to parse the output as JSON
-                try:
-                    result = json.loads(process.stdout)
-                    return jsonify({"success": True, "sheets": result})
-                except json.JSONDecodeError:
-                    # If not JSON, assume it's a list of sheet names separated by newlines
-                    sheets = [s.strip() for s in process.stdout.strip().split('\n') if s.strip()]
-                    return jsonify({"success": True, "sheets": sheets})
-                    
-            except Exception as subprocess_error:
-                return jsonify({"error": f"Error reading Excel sheets: {str(subprocess_error)}"}), 500
+            app.logger.error(f"Error reading Excel sheets: {str(e)}")
+            return jsonify({"error": f"Error reading Excel sheets: {str(e)}"}), 500
             
     except Exception as e:
         app.logger.error(f"Error getting Excel sheets: {str(e)}")
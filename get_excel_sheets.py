@@ -1,14 +1,31 @@
-import pandas as pd
 import sys
 import json
+import zipfile
+from xml.etree import ElementTree
+
+# Namespace of the <sheet> elements in xl/workbook.xml
+SPREADSHEETML_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+
+def read_sheet_names(file_path):
+    try:
+        # xlsx/xlsm list their sheets in xl/workbook.xml; no sheet has to be parsed
+        with zipfile.ZipFile(file_path) as package:
+            root = ElementTree.fromstring(package.read('xl/workbook.xml'))
+        sheet_names = [sheet.get('name') for sheet in root.iter(f'{{{SPREADSHEETML_NS}}}sheet')]
+        if sheet_names:
+            return sheet_names
+        # None found: likely Strict OOXML, whose elements use another namespace
+    except (zipfile.BadZipFile, KeyError):
+        pass  # .xls, or a package without workbook.xml (.xlsb)
+    
+    # Everything else goes through pandas, imported only when needed
+    import pandas as pd
+    with pd.ExcelFile(file_path) as xls:
+        return xls.sheet_names
 
 def get_excel_sheets(file_path):
     try:
-        # Load Excel file
-        xls = pd.ExcelFile(file_path)
-        
-        # Get sheet names
-        sheet_names = xls.sheet_names
+        sheet_names = read_sheet_names(file_path)
         
         # Return sheet names as JSON
         print(json.dumps({"sheets": sheet_names}))
@@ -10,6 +10,10 @@ import os
 import sys
 import pandas as pd
 import PyPDF2
+try:
+    import fitz  # PyMuPDF: C-backed text extraction, much faster than PyPDF2
+except ImportError:
+    fitz = None
 import anthropic
 import json
 import tempfile
@@ -31,13 +35,14 @@ def safe_print(message):
 def extract_text_from_pdf(pdf_path):
     """Extract text content from a PDF file."""
     try:
-        text = ""
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text() + "\n\n"
-        return text
+        if fitz is not None:
+            with fitz.open(pdf_path) as doc:
+                pages = [page.get_text("text") for page in doc]
+        else:
+            with open(pdf_path, 'rb') as file:
+                pdf_reader = PyPDF2.PdfReader(file)
+                pages = [page.extract_text() for page in pdf_reader.pages]
+        return "".join(page_text + "\n\n" for page_text in pages)
     except Exception as e:
         safe_print(f"Error extracting text from PDF: {str(e)}")
         return ""
@@ -48,15 +53,15 @@ def read_excel_sheet(excel_path, sheet_name=None):
         if sheet_name:
             return pd.read_excel(excel_path, sheet_name=sheet_name)
         else:
-            # Get all sheet names
-            xls = pd.ExcelFile(excel_path)
-            sheet_names = xls.sheet_names
-            
-            # Use the first sheet if none specified
-            if sheet_names:
-                return pd.read_excel(excel_path, sheet_name=sheet_names[0])
-            else:
-                raise ValueError("No sheets found in the Excel file")
+            # Get all sheet names, reading from the same open file
+            with pd.ExcelFile(excel_path) as xls:
+                sheet_names = xls.sheet_names
+                
+                # Use the first sheet if none specified
+                if sheet_names:
+                    return pd.read_excel(xls, sheet_name=sheet_names[0])
+                else:
+                    raise ValueError("No sheets found in the Excel file")
     except Exception as e:
         safe_print(f"Error reading Excel file: {str(e)}")
         raise
@@ -91,13 +96,10 @@ def extract_first_json(text):
 def construct_prompt(coa_sheet, structure, invoice_text):
     """Construct a prompt for Claude to classify the invoice."""
     # Convert COA sheet to a string representation
+    columns = [col for col in structure['columns'] if col in coa_sheet.columns]
     coa_data = []
-    for _, row in coa_sheet.iterrows():
-        row_data = []
-        for col in structure['columns']:
-            if col in row:
-                row_data.append(f"{col}: {row[col]}")
-        coa_data.append(", ".join(row_data))
+    for values in coa_sheet[columns].astype(str).itertuples(index=False, name=None):
+        coa_data.append(", ".join(f"{col}: {value}" for col, value in zip(columns, values)))
     
     coa_text = "\n".join(coa_data)
     
@@ -246,12 +248,10 @@ def classify_invoice_with_claude(invoice_text, coa_sheet, structure, api_key):
     """
     
     # Get example rows from the COA sheet
+    columns = [col for col in structure['columns'] if col in coa_sheet.columns]
     example_rows = []
-    for _, row in coa_sheet.head(3).iterrows():
-        example_row = {}
-        for col in structure['columns']:
-            if col in row and pd.notna(row[col]):
-                example_row[col] = str(row[col])
+    for row in coa_sheet.head(3)[columns].to_dict(orient='records'):
+        example_row = {col: str(value) for col, value in row.items() if pd.notna(value)}
         if example_row:
             example_rows.append(example_row)
     
@@ -414,11 +414,10 @@ def process_invoice(coa_path, invoice_path, sheet_name=None, existing_file_path=
         # Add the invoice data to the Excel file
         try:
             with pd.ExcelWriter(output_path, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-                # Read the existing sheet
-                df = pd.read_excel(output_path, sheet_name=sheet_name)
-                # Add the new row
+                # output_path is a byte-for-byte copy of coa_path, so reuse the
+                # sheet read above instead of parsing the workbook again
                 new_row = pd.DataFrame([invoice_data])
-                df = pd.concat([df, new_row], ignore_index=True)
+                df = pd.concat([coa_sheet, new_row], ignore_index=True)
                 # Write back to the sheet
                 df.to_excel(writer, sheet_name=sheet_name, index=False)
         except Exception as e:
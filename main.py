@@ -1,19 +1,27 @@
-from flask import Flask, jsonify, request, send_from_directory, current_app
+from flask import Flask, jsonify, request, send_file, current_app
 import os
 import sys
+import atexit
+import logging
+import logging.handlers
+import queue
 import traceback
-import uuid
+import secrets
+import functools
+import contextlib
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-import pandas as pd
+from datetime import datetime, timezone
 import json
 from perfect4 import (
-    process_invoice_file,
-    get_excel_sheets,
-    safe_print,
-    analyze_excel_structure,
-    update_chart_of_accounts
+    process_invoice_batch,
+    get_excel_sheets
 )
 
 # Initialize Flask app and configuration
@@ -23,38 +31,100 @@ CORS(app)  # Enable CORS for all routes
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+def configure_logging():
+    """Route log records through a queue so stdout writes happen on a background thread."""
+    default_level = 'DEBUG' if os.environ.get('FLASK_ENV') == 'development' else 'INFO'
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(os.environ.get('LOG_LEVEL', default_level).upper())
+    
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+configure_logging()
+
 # Configure file upload settings
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', os.path.join(BASE_DIR, 'uploads'))
 PROCESSED_FOLDER = os.environ.get('PROCESSED_FOLDER', os.path.join(BASE_DIR, 'processed'))
 TEMP_FOLDER = os.environ.get('TEMP_FOLDER', os.path.join(BASE_DIR, 'temp'))
+JOBS_FOLDER = os.path.join(TEMP_FOLDER, 'jobs')
 
 # Create required directories
-for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER, TEMP_FOLDER]:
+for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER, TEMP_FOLDER, JOBS_FOLDER]:
     os.makedirs(folder, exist_ok=True)
-    safe_print(f"Created directory: {folder}")
+    logger.debug("Created directory: %s", folder)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PROCESSED_FOLDER'] = PROCESSED_FOLDER
 app.config['TEMP_FOLDER'] = TEMP_FOLDER
+app.config['JOBS_FOLDER'] = JOBS_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+# Set here rather than in app.run so gunicorn and pool workers agree on it
+app.config['DEBUG'] = os.environ.get('FLASK_ENV') == 'development'
+
+# Invoice jobs run in a process pool so Excel parsing never blocks a request thread.
+# Workers are spawned rather than forked because this process already runs threads.
+# Every gunicorn worker has its own pool, so the default is one process per pool
+def new_invoice_executor():
+    return ProcessPoolExecutor(
+        max_workers=int(os.environ.get('INVOICE_WORKERS', 1)),
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+# Created on first use: spawned workers re-import this module, and each of them
+# would otherwise start a pool of its own
+executor = None
+executor_lock = threading.Lock()
+
+def submit_invoice_job(*args):
+    """Submit a job to the invoice pool, replacing the pool if a dead worker broke it."""
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = new_invoice_executor()
+        try:
+            return executor.submit(run_invoice_job, *args)
+        except BrokenProcessPool:
+            # A worker died (out of memory, a crash in a PDF library); the pool
+            # refuses all further work, so start a fresh one
+            logger.warning("Invoice process pool is broken; starting a new one")
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = new_invoice_executor()
+            return executor.submit(run_invoice_job, *args)
+
+# Finished jobs' status files are kept this long for polling, then removed
+JOB_STATUS_TTL = int(os.environ.get('JOB_STATUS_TTL', 24 * 60 * 60))
+
+# Static part of the health payload; only the timestamp changes per call
+HEALTH_PAYLOAD = {
+    'status': 'healthy',
+    'directories': {
+        'uploads': app.config['UPLOAD_FOLDER'],
+        'processed': app.config['PROCESSED_FOLDER'],
+        'temp': app.config['TEMP_FOLDER']
+    }
+}
 
 # Health check endpoint
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({
-        'status': 'healthy',
-        'timestamp': pd.Timestamp.now().isoformat(),
-        'directories': {
-            'uploads': app.config['UPLOAD_FOLDER'],
-            'processed': app.config['PROCESSED_FOLDER'],
-            'temp': app.config['TEMP_FOLDER']
-        }
+        **HEALTH_PAYLOAD,
+        'timestamp': datetime.now(timezone.utc).isoformat()
     }), 200
 
-@app.route('/', methods=['GET'])
-def index():
-    return """
+# The documentation page never changes, so encode its body once at import.
+# Each request still gets its own Response so CORS headers never leak between origins.
+INDEX_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -98,6 +168,12 @@ def index():
                 <li><code>chart</code> - The chart of accounts Excel file</li>
                 <li><code>sheet_name</code> - (Optional) Sheet name in the Excel file (default: 'COA i-Kcal')</li>
             </ul>
+            <p>Returns <code>202</code> with a <code>job_id</code> and <code>status_url</code> to poll.</p>
+        </div>
+        
+        <div class="endpoint">
+            <h3>Process Status</h3>
+            <p><code>GET /api/process-status/&lt;job_id&gt;</code> - Check a queued invoice job; returns the <code>download_url</code> once it has finished</p>
         </div>
         
         <div class="endpoint">
@@ -111,205 +187,390 @@ def index():
         </div>
     </body>
     </html>
-    """
+    """.encode('utf-8')
+
+@app.route('/', methods=['GET'])
+def index():
+    return app.response_class(INDEX_HTML, mimetype='text/html')
+
+
+def remove_files(*paths):
+    # A single unlink per file; a missing file is already the desired outcome
+    for file_path in paths:
+        if not file_path:
+            continue
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Error removing file %s: %s", file_path, e)
+
+# Leading bytes of the formats we accept; .xls is OLE2, .xlsx/.xlsm are ZIP
+PDF_MAGIC = (b'%PDF-',)
+EXCEL_MAGIC = (b'PK\x03\x04', b'\xd0\xcf\x11\xe0')
+ALLOWED_EXCEL_EXTENSIONS = frozenset({'.xlsx', '.xls', '.xlsm'})
+ALLOWED_PDF_EXTENSIONS = frozenset({'.pdf'})
+
+def reject_oversized_upload():
+    # Refuse from the headers alone, before the multipart body is parsed
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'status': 'error', 'message': 'Upload exceeds the 16MB limit'}), 413
+    if request.mimetype != 'multipart/form-data':
+        return jsonify({'status': 'error', 'message': 'Expected a multipart/form-data upload'}), 400
+    return None
+
+def has_extension(filename, allowed):
+    return bool(filename) and os.path.splitext(filename)[1].lower() in allowed
+
+@contextlib.contextmanager
+def saved_upload(file, prefix):
+    # A random name avoids collisions between concurrent uploads of the same file
+    extension = os.path.splitext(file.filename)[1].lower()
+    path = os.path.join(app.config['TEMP_FOLDER'], f'{prefix}_{secrets.token_hex(6)}{extension}')
+    file.save(path)
+    try:
+        yield path
+    finally:
+        remove_files(path)
+
+def sheets_response(file_path, **extra):
+    # Get sheet names using the function from perfect4.py
+    return jsonify({'status': 'success', **extra, 'sheets': get_excel_sheets(file_path)})
+
+def has_magic(file, signatures):
+    # Sniff the first bytes of the upload, then rewind so save() sees the whole file
+    head = file.stream.read(8)
+    file.stream.seek(0)
+    return head.startswith(signatures)
+
+def list_files(directory):
+    # One scandir pass; is_file() comes from the directory listing, but on Linux
+    # each size still costs a stat call (DirEntry caches it on Windows only)
+    with os.scandir(directory) as it:
+        return [(entry.name, entry.stat().st_size) for entry in it if entry.is_file()]
+
+# Persist job state to disk so any gunicorn worker can answer a status poll
+def job_status_path(job_id):
+    return os.path.join(app.config['JOBS_FOLDER'], f'{job_id}.json')
+
+def write_job_status(job_id, payload):
+    status_path = job_status_path(job_id)
+    tmp_path = f'{status_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, status_path)
+
+def read_job_status(job_id):
+    try:
+        with open(job_status_path(job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists but belongs to another user
+    return True
+
+def prune_job_statuses(max_age=None):
+    """Remove status files not updated for max_age seconds (JOB_STATUS_TTL by default)."""
+    cutoff = time.time() - (JOB_STATUS_TTL if max_age is None else max_age)
+    with os.scandir(app.config['JOBS_FOLDER']) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Pruned by another worker
+
+def run_invoice_job(invoice_paths, chart_path, sheet_name, output_dir, unique_id):
+    """Process the uploaded invoices in a worker process and record the outcome for polling."""
+    try:
+        write_job_status(unique_id, {'status': 'processing', 'job_id': unique_id, 'owner_pid': os.getppid()})
+        
+        # Process the invoice using perfect4 module
+        logger.info("Starting invoice processing for job %s (sheet: %s)", unique_id, sheet_name)
+        
+        # Directory listings grow with every job, so only take them at debug level
+        debug_listing = logger.isEnabledFor(logging.DEBUG)
+        if debug_listing:
+            logger.debug("Current working directory: %s", os.getcwd())
+            for invoice_path in invoice_paths:
+                logger.debug("Invoice path: %s (exists: %s)", invoice_path, os.path.exists(invoice_path))
+            logger.debug("Chart path: %s (exists: %s)", chart_path, os.path.exists(chart_path))
+            logger.debug("Output dir: %s (exists: %s)", output_dir, os.path.exists(output_dir))
+            try:
+                upload_files = list_files(os.path.dirname(chart_path))
+                logger.debug("Files in upload directory: %s", upload_files)
+            except Exception as e:
+                logger.debug("Error listing upload directory: %s", e)
+            
+            try:
+                output_files_before = list_files(output_dir)
+                logger.debug("Files in output directory before processing: %s", output_files_before)
+            except Exception as e:
+                logger.debug("Error listing output directory: %s", e)
+        
+        logger.debug("Calling process_invoice_batch...")
+        result = process_invoice_batch(
+            invoice_paths=invoice_paths,
+            chart_path=chart_path,
+            sheet_name=sheet_name,
+            output_dir=output_dir,
+            unique_id=unique_id
+        )
+        
+        # List files in the output directory after processing
+        if debug_listing:
+            try:
+                output_files_after = list_files(output_dir)
+                logger.debug("Files in output directory after processing: %s", output_files_after)
+                # Compare names only: a file rewritten in place isn't new
+                new_files = sorted({name for name, _ in output_files_after} - {name for name, _ in output_files_before})
+                if new_files:
+                    logger.debug("New files created: %s", new_files)
+                else:
+                    logger.debug("No new files were created")
+            except Exception as e:
+                logger.debug("Error listing output directory after processing: %s", e)
+        
+        # Log the result
+        logger.info("Job %s finished with status %s: %s", unique_id, result.get('status'), result.get('message'))
+        
+        # Ensure the output path is using the correct processed directory
+        if 'output_path' in result:
+            # Make sure the path is using the correct directory
+            filename = os.path.basename(result['output_path'])
+            result['output_path'] = os.path.join(output_dir, filename)
+            result['output_filename'] = filename
+            logger.debug("Output file: %s", result['output_path'])
+            
+            # Verify the file was created
+            if os.path.exists(result['output_path']):
+                file_size = os.path.getsize(result['output_path'])
+                logger.debug("File created successfully. Size: %d bytes", file_size)
+            else:
+                logger.warning("Output file not found after processing: %s", result['output_path'])
+        
+        # Add download link and file info to the response
+        if 'status' in result and result['status'] == 'success':
+            download_url = f'/api/download-file/{os.path.basename(result["output_path"])}'
+            # Create the response object with the structure expected by the frontend
+            response_data = {
+                'status': 'success',
+                'job_id': unique_id,
+                'message': result.get('message', 'Invoice processed successfully'),
+                'download_url': download_url,
+                'file_info': {
+                    'filename': result.get('output_filename', ''),
+                    'path': result.get('output_path', ''),
+                    'download_url': download_url,
+                    'file_type': 'excel'
+                },
+                'invoice_data': result.get('invoice_data', {}),
+                'invoices': result.get('invoices', [])
+            }
+        else:
+            # If there was an error, return the error details
+            error_msg = result.get('message', 'Failed to process invoice')
+            error_trace = result.get('trace', '')
+            logger.error("Processing failed: %s\n%s", error_msg, error_trace)
+            
+            response_data = {
+                'status': 'error',
+                'job_id': unique_id,
+                'error': error_msg
+            }
+            if app.debug:
+                response_data['details'] = error_trace
+        
+        write_job_status(unique_id, response_data)
+        return response_data
+    
+    finally:
+        # Clean up uploaded files
+        remove_files(*invoice_paths, chart_path)
 
+def record_job_failure(job_id, invoice_paths, chart_path, future):
+    # A crashed worker process never writes its own status or reaches the
+    # job's cleanup, so record the failure and remove the uploads here
+    if future.cancelled():
+        logger.error("Job %s was cancelled", job_id)
+        error_msg = 'Job was cancelled before it ran'
+    else:
+        error = future.exception()
+        if error is None:
+            return
+        logger.error("Job %s failed: %s", job_id, error)
+        error_msg = str(error)
+    
+    write_job_status(job_id, {
+        'status': 'error',
+        'job_id': job_id,
+        'error': error_msg
+    })
+    remove_files(*invoice_paths, chart_path)
 
 # Route to handle file uploads and process invoices
 @app.route('/api/process-invoice', methods=['POST'])
 def process_invoice():
     # Initialize variables
-    invoice_path = None
+    invoice_paths = []
     chart_path = None
+    unique_id = None
+    submitted = False
     
     try:
+        rejection = reject_oversized_upload()
+        if rejection:
+            return rejection
+        
         # Debug: Log request data
-        safe_print("Received request with form data:", request.form)
-        safe_print("Received files:", request.files)
+        logger.debug("Received request with form data: %s", request.form)
+        logger.debug("Received files: %s", request.files)
         
-        # Get files from request
-        invoice_file = request.files.get('invoiceFile')
+        # Get files from request; several invoiceFile parts are processed as one batch
+        invoice_files = [f for f in request.files.getlist('invoiceFile') if f]
         chart_file = request.files.get('coaFile')
         
-        safe_print(f"Invoice file: {invoice_file.filename if invoice_file else 'Not found'}")
-        safe_print(f"Chart file: {chart_file.filename if chart_file else 'Not found'}")
+        logger.debug("Invoice files: %s", [f.filename for f in invoice_files] or 'Not found')
+        logger.debug("Chart file: %s", chart_file.filename if chart_file else 'Not found')
         
         # Check if files are present in the request
-        if not invoice_file or not chart_file:
+        if not invoice_files or not chart_file:
             return jsonify({
                 'status': 'error', 
                 'message': 'Both invoice (PDF) and chart of accounts (Excel) files are required',
                 'received_files': {
-                    'invoice': bool(invoice_file),
+                    'invoice': bool(invoice_files),
                     'chart': bool(chart_file)
                 }
             }), 400
             
         # Validate file types
-        if not (invoice_file.filename and invoice_file.filename.lower().endswith('.pdf')):
+        for invoice_file in invoice_files:
+            if not has_extension(invoice_file.filename, ALLOWED_PDF_EXTENSIONS):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Invoice file must be a PDF',
+                    'received_file': invoice_file.filename
+                }), 400
+            
+        if not has_extension(chart_file.filename, ALLOWED_EXCEL_EXTENSIONS):
             return jsonify({
                 'status': 'error',
-                'message': 'Invoice file must be a PDF',
-                'received_file': invoice_file.filename
+                'message': 'Chart of accounts must be an Excel file (.xlsx, .xls, .xlsm)',
+                'received_file': chart_file.filename
             }), 400
+        
+        # Check the contents match the extension before saving the uploads
+        for invoice_file in invoice_files:
+            if not has_magic(invoice_file, PDF_MAGIC):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Invoice file is not a valid PDF',
+                    'received_file': invoice_file.filename
+                }), 400
             
-        if not (chart_file.filename and (chart_file.filename.lower().endswith('.xlsx') or 
-                                       chart_file.filename.lower().endswith('.xls') or
-                                       chart_file.filename.lower().endswith('.xlsm'))):
+        if not has_magic(chart_file, EXCEL_MAGIC):
             return jsonify({
                 'status': 'error',
-                'message': 'Chart of accounts must be an Excel file (.xlsx, .xls, .xlsm)',
+                'message': 'Chart of accounts is not a valid Excel file',
                 'received_file': chart_file.filename
             }), 400
             
         # Get sheet name from form data or use default
         sheet_name = request.form.get('sheetName', 'COA i-Kcal')
-        safe_print(f"Using sheet name: {sheet_name}")
+        logger.debug("Using sheet name: %s", sheet_name)
         
         # Generate unique ID for this processing job
-        unique_id = str(uuid.uuid4())[:8]
-        safe_print(f"Generated unique ID: {unique_id}")
-        
-        # Ensure upload folder exists
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        unique_id = secrets.token_hex(4)
+        logger.debug("Generated unique ID: %s", unique_id)
         
         # Save uploaded files with secure filenames
-        invoice_filename = f'invoice_{unique_id}.pdf'
         chart_filename = f'chart_{unique_id}.xlsx'
-        
-        invoice_path = os.path.join(app.config['UPLOAD_FOLDER'], invoice_filename)
         chart_path = os.path.join(app.config['UPLOAD_FOLDER'], chart_filename)
         
-        safe_print(f"Saving invoice to: {invoice_path}")
-        safe_print(f"Saving chart to: {chart_path}")
+        logger.debug("Saving chart to: %s", chart_path)
         
         # Save files
-        invoice_file.save(invoice_path)
         chart_file.save(chart_path)
-        
-        safe_print("Files saved successfully. Starting processing...")
-        
-        # Ensure the processed directory exists
-        processed_dir = app.config['PROCESSED_FOLDER']
-        os.makedirs(processed_dir, exist_ok=True)
-        
-        # Process the invoice using perfect4 module
-        safe_print(f"\n=== Starting invoice processing ===")
-        safe_print(f"Current working directory: {os.getcwd()}")
-        safe_print(f"Invoice path: {invoice_path} (exists: {os.path.exists(invoice_path)})")
-        safe_print(f"Chart path: {chart_path} (exists: {os.path.exists(chart_path)})")
-        safe_print(f"Sheet: {sheet_name}")
-        safe_print(f"Output dir: {processed_dir} (exists: {os.path.exists(processed_dir)})")
-        safe_print(f"Unique ID: {unique_id}")
-        
-        # List files in the upload directory for debugging
-        try:
-            upload_files = os.listdir(os.path.dirname(invoice_path))
-            safe_print(f"Files in upload directory: {upload_files}")
-        except Exception as e:
-            safe_print(f"Error listing upload directory: {str(e)}")
-        
-        # List files in the output directory before processing
-        try:
-            output_files_before = os.listdir(processed_dir)
-            safe_print(f"Files in output directory before processing: {output_files_before}")
-        except Exception as e:
-            safe_print(f"Error listing output directory: {str(e)}")
-        
-        safe_print("\nCalling process_invoice_file...")
-        result = process_invoice_file(
-            invoice_path=invoice_path,
-            chart_path=chart_path,
-            sheet_name=sheet_name,
-            output_dir=processed_dir,
-            unique_id=unique_id
+        for index, invoice_file in enumerate(invoice_files):
+            invoice_filename = f'invoice_{unique_id}.pdf' if index == 0 else f'invoice_{unique_id}_{index}.pdf'
+            invoice_path = os.path.join(app.config['UPLOAD_FOLDER'], invoice_filename)
+            logger.debug("Saving invoice to: %s", invoice_path)
+            invoice_paths.append(invoice_path)
+            invoice_file.save(invoice_path)
+        
+        logger.debug("Files saved successfully. Starting processing...")
+        
+        # Hand the job to the process pool; the client polls the status URL
+        prune_job_statuses()
+        write_job_status(unique_id, {'status': 'queued', 'job_id': unique_id, 'owner_pid': os.getpid()})
+        future = submit_invoice_job(
+            invoice_paths,
+            chart_path,
+            sheet_name,
+            app.config['PROCESSED_FOLDER'],
+            unique_id
         )
+        submitted = True
+        future.add_done_callback(functools.partial(record_job_failure, unique_id, invoice_paths, chart_path))
+        logger.info("Queued invoice job %s (%d invoice(s))", unique_id, len(invoice_paths))
         
-        # List files in the output directory after processing
-        try:
-            output_files_after = os.listdir(processed_dir)
-            safe_print(f"Files in output directory after processing: {output_files_after}")
-            new_files = list(set(output_files_after) - set(output_files_before))
-            if new_files:
-                safe_print(f"New files created: {new_files}")
-            else:
-                safe_print("No new files were created")
-        except Exception as e:
-            safe_print(f"Error listing output directory after processing: {str(e)}")
-        
-        # Log the result
-        safe_print("\n=== Processing Result ===")
-        safe_print(f"Status: {result.get('status')}")
-        safe_print(f"Message: {result.get('message')}")
-        
-        # Ensure the output path is using the correct processed directory
-        if 'output_path' in result:
-            # Make sure the path is using the correct directory
-            filename = os.path.basename(result['output_path'])
-            result['output_path'] = os.path.join(processed_dir, filename)
-            result['output_filename'] = filename
-            safe_print(f"Output file: {result['output_path']}")
-            
-            # Verify the file was created
-            if os.path.exists(result['output_path']):
-                file_size = os.path.getsize(result['output_path'])
-                safe_print(f"File created successfully. Size: {file_size} bytes")
-            else:
-                safe_print("WARNING: Output file not found after processing")
-        
-        # Add download link and file info to the response
-        if 'status' in result and result['status'] == 'success':
-            # Create the response object with the structure expected by the frontend
-            response_data = {
-                'status': 'success',
-                'message': result.get('message', 'Invoice processed successfully'),
-                'file_info': {
-                    'filename': result.get('output_filename', ''),
-                    'path': result.get('output_path', ''),
-                    'download_url': f'/api/download-file/{os.path.basename(result["output_path"])}',
-                    'file_type': 'excel'
-                },
-                'invoice_data': result.get('invoice_data', {})
-            }
-            safe_print("\n=== Processing completed successfully ===\n")
-            return jsonify(response_data)
-        else:
-            # If there was an error, return the error details
-            error_msg = result.get('message', 'Failed to process invoice')
-            error_trace = result.get('trace', '')
-            safe_print(f"\n!!! PROCESSING FAILED: {error_msg}")
-            if error_trace:
-                safe_print(f"Error details:\n{error_trace}")
-                
-            return jsonify({
-                'status': 'error',
-                'error': error_msg,
-                'details': error_trace
-            }), 500
+        return jsonify({
+            'status': 'queued',
+            'job_id': unique_id,
+            'status_url': f'/api/process-status/{unique_id}'
+        }), 202
         
     except Exception as e:
-        error_trace = traceback.format_exc()
-        error_message = str(e)
-        safe_print(f"Error in process_invoice: {error_message}\n{error_trace}")
-        return jsonify({
+        logger.exception("Error in process_invoice: %s", e)
+        response_data = {
             'status': 'error',
-            'error': error_message,
-            'message': error_message,  # For backward compatibility
-            'details': error_trace,
+            'error': str(e),
+            'message': str(e),  # For backward compatibility
+            'request_id': unique_id,
             'file_info': None
-        }), 500
+        }
+        if app.debug:
+            response_data['details'] = traceback.format_exc()
+        return jsonify(response_data), 500
         
     finally:
-        # Clean up uploaded files
-        for file_path in [invoice_path, chart_path]:
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except Exception as e:
-                    safe_print(f"Error removing file {file_path}: {str(e)}")
+        # Once submitted, the job owns the uploads and removes them itself
+        if not submitted:
+            remove_files(*invoice_paths, chart_path)
+
+# Route to poll a queued invoice job
+@app.route('/api/process-status/<job_id>', methods=['GET'])
+def process_status(job_id):
+    # Job ids are hex tokens; reject anything else before touching the filesystem
+    if not job_id.isalnum():
+        return jsonify({'status': 'error', 'error': 'Invalid job id'}), 400
+    
+    status = read_job_status(job_id)
+    if status is None:
+        return jsonify({'status': 'error', 'error': f'Unknown job id: {job_id}'}), 404
+    
+    # Pending jobs live in the pool of the gunicorn worker that accepted them;
+    # if that worker has exited (restart, max_requests, crash) they never finish
+    if status['status'] in ('queued', 'processing') and not pid_alive(status.get('owner_pid', os.getpid())):
+        status = {'status': 'error', 'job_id': job_id, 'error': 'Server worker stopped before the job finished'}
+        write_job_status(job_id, status)
+    
+    if status['status'] == 'error':
+        return jsonify(status), 500
+    return jsonify(status), 200
 
 # Route to get sheet names from an Excel file
 @app.route('/api/get-sheets', methods=['GET', 'POST'])
-def get_excel_sheets():
+def get_sheets():
     try:
         if request.method == 'GET':
             # Handle GET request with file_path parameter
@@ -327,56 +588,39 @@ def get_excel_sheets():
                     'message': f'File not found: {file_path}'
                 }), 404
             
-            # Get sheet names using the function from perfect4.py
-            sheet_names = get_excel_sheets(file_path)
-            
-            return jsonify({
-                'status': 'success',
-                'file_path': file_path,
-                'sheets': sheet_names
-            })
-            
-        elif request.method == 'POST':
-            # Handle file upload
-            if 'file' not in request.files:
-                return jsonify({'status': 'error', 'message': 'No file provided'}), 400
-                
-            file = request.files['file']
-            
-            if file.filename == '':
-                return jsonify({'status': 'error', 'message': 'No file selected'}), 400
-                
-            if not file.filename.endswith(('.xls', '.xlsx')):
-                return jsonify({'status': 'error', 'message': 'File must be an Excel file (.xls or .xlsx)'}), 400
+            return sheets_response(file_path, file_path=file_path)
+        
+        rejection = reject_oversized_upload()
+        if rejection:
+            return rejection
+        
+        # Handle file upload
+        if 'file' not in request.files:
+            return jsonify({'status': 'error', 'message': 'No file provided'}), 400
             
-            # Save the file temporarily
-            temp_path = os.path.join(app.config['TEMP_FOLDER'], secure_filename(file.filename))
-            file.save(temp_path)
+        file = request.files['file']
+        
+        if file.filename == '':
+            return jsonify({'status': 'error', 'message': 'No file selected'}), 400
             
-            try:
-                # Get sheet names using the function from perfect4.py
-                sheet_names = get_excel_sheets(temp_path)
-                
-                return jsonify({
-                    'status': 'success',
-                    'filename': file.filename,
-                    'sheets': sheet_names
-                })
-            finally:
-                # Clean up the temporary file
-                try:
-                    os.remove(temp_path)
-                except Exception as e:
-                    safe_print(f"Error removing temporary file: {str(e)}")
+        if not has_extension(file.filename, ALLOWED_EXCEL_EXTENSIONS):
+            return jsonify({'status': 'error', 'message': 'File must be an Excel file (.xlsx, .xls, .xlsm)'}), 400
+        
+        if not has_magic(file, EXCEL_MAGIC):
+            return jsonify({'status': 'error', 'message': 'File is not a valid Excel file'}), 400
+        
+        with saved_upload(file, 'sheets') as temp_path:
+            return sheets_response(temp_path, filename=file.filename)
     
     except Exception as e:
-        error_trace = traceback.format_exc()
-        safe_print(f"Error in get_excel_sheets: {str(e)}\n{error_trace}")
-        return jsonify({
+        logger.exception("Error in get_sheets: %s", e)
+        response_data = {
             'status': 'error',
-            'message': str(e),
-            'trace': error_trace
-        }), 500
+            'message': str(e)
+        }
+        if app.debug:
+            response_data['trace'] = traceback.format_exc()
+        return jsonify(response_data), 500
 
 # Route to download processed files
 @app.route('/api/download-file/<path:filename>', methods=['GET'])
@@ -390,32 +634,39 @@ def download_file(filename):
         # If we still don't have a filename, return an error
         if not filename:
             error_msg = "No filename provided. Use /api/download-file/<filename> or /api/download-file?filename=<filename>"
-            safe_print(f"Error: {error_msg}")
+            logger.warning(error_msg)
             return jsonify({
                 'status': 'error',
                 'error': error_msg
             }), 400
         
-        safe_print(f"\n=== Download Request ===")
-        safe_print(f"Requested file: {filename}")
+        logger.debug("Download requested: %s", filename)
         
         # Ensure the filename is secure and doesn't contain path traversal
         filename = secure_filename(os.path.basename(filename))
-        safe_print(f"Sanitized filename: {filename}")
+        logger.debug("Sanitized filename: %s", filename)
+        
+        # ETag sidecars are internal bookkeeping, not downloads
+        if filename.endswith('.etag'):
+            logger.warning("Refused download of ETag file: %s", filename)
+            return jsonify({
+                'status': 'error',
+                'error': f'File not found: {filename}'
+            }), 404
         
         # Define the base directory for downloads
         base_dir = app.config['PROCESSED_FOLDER']
-        safe_print(f"Base directory: {base_dir}")
+        logger.debug("Base directory: %s", base_dir)
         
         # Construct absolute path
         file_path = os.path.abspath(os.path.join(base_dir, filename))
-        safe_print(f"Full file path: {file_path}")
+        logger.debug("Full file path: %s", file_path)
         
         # Security check: Ensure the file is within the allowed directory
         abs_base_dir = os.path.abspath(base_dir)
         if not file_path.startswith(abs_base_dir):
             error_msg = f"Security alert: Attempted path traversal: {file_path} (base: {abs_base_dir})"
-            safe_print(error_msg)
+            logger.warning(error_msg)
             return jsonify({
                 'status': 'error',
                 'error': 'Invalid file path',
@@ -424,52 +675,59 @@ def download_file(filename):
         
         # Check if file exists
         if not os.path.exists(file_path):
-            error_msg = f"File not found: {file_path}"
-            safe_print(error_msg)
+            logger.warning("File not found: %s", file_path)
             
             # Try to list files in the directory for debugging
+            files = []
             try:
-                files = os.listdir(base_dir)
-                safe_print(f"\nAvailable files in {base_dir}:")
-                for f in files:
-                    safe_print(f"- {f} (size: {os.path.getsize(os.path.join(base_dir, f))} bytes)")
+                entries = list_files(base_dir)
+                files = [name for name, _ in entries if not name.endswith('.etag')]
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Available files in %s:", base_dir)
+                    for name, size in entries:
+                        logger.debug("- %s (size: %d bytes)", name, size)
             except Exception as e:
-                safe_print(f"Error listing directory {base_dir}: {str(e)}")
+                logger.warning("Error listing directory %s: %s", base_dir, e)
             
             return jsonify({
                 'status': 'error',
                 'error': f'File not found: {filename}',
-                'available_files': files if 'files' in locals() else [],
+                'available_files': files,
                 'directory': base_dir
             }), 404
             
-        # Get file stats for logging
-        file_size = os.path.getsize(file_path)
-        safe_print(f"File found. Size: {file_size} bytes")
-        
         # Log the download attempt
-        safe_print(f"Serving file: {file_path}")
+        logger.info("Serving file: %s", file_path)
+        
+        # Use the content hash written at processing time so repeat downloads get a 304
+        try:
+            with open(f'{file_path}.etag') as f:
+                etag = f.read().strip()
+        except FileNotFoundError:
+            etag = True  # Fall back to Flask's mtime/size based ETag
         
         # Send the file
-        response = send_from_directory(
-            directory=os.path.dirname(file_path),
-            path=os.path.basename(file_path),
+        response = send_file(
+            file_path,
             as_attachment=True,
-            download_name=filename  # This sets the filename in the download dialog
+            download_name=filename,  # This sets the filename in the download dialog
+            conditional=True,
+            etag=etag,
+            last_modified=os.stat(file_path).st_mtime
         )
         
-        safe_print("File sent successfully")
         return response
         
     except Exception as e:
         error_msg = f"Error downloading file: {str(e)}"
-        safe_print(f"\n!!! ERROR: {error_msg}")
-        traceback.print_exc()
-        return jsonify({
+        logger.exception(error_msg)
+        response_data = {
             'status': 'error',
-            'error': error_msg,
-            'trace': traceback.format_exc()
-        }), 500
+            'error': error_msg
+        }
+        if app.debug:
+            response_data['trace'] = traceback.format_exc()
+        return jsonify(response_data), 500
 
 # This is needed for running with Gunicorn on Render
 application = app
@@ -477,4 +735,4 @@ application = app
 if __name__ == '__main__':
     # Get port from environment variable or use default 10000
     port = int(os.environ.get('PORT', 10000))
-    app.run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_ENV') == 'development')
+    app.run(host='0.0.0.0', port=port, debug=app.debug)
@@ -9,99 +9,317 @@ Date: 01/04/2025
 Version: 1.0
 """
 
-import pandas as pd
+# pandas is imported inside the functions that use it: the web process only
+# lists sheets and queues jobs, so it never has to load it
 import PyPDF2
+try:
+    import fitz  # PyMuPDF: C-backed text extraction, much faster than PyPDF2
+except ImportError:
+    fitz = None
+try:
+    import pypdfium2  # PDFium bindings: permissively licensed alternative to PyMuPDF
+except ImportError:
+    pypdfium2 = None
 import re
 import json
+try:
+    import orjson  # C-backed JSON, several times faster than the stdlib module
+except ImportError:
+    orjson = None
 import os
 import shutil
+import hashlib
+import mmap
+import pickle
+import copy
 import traceback
+import logging
+import threading
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, Any, List, Optional, Union, Tuple
 import openpyxl
-from openpyxl.utils import get_column_letter
-import PyPDF2
+from openpyxl import load_workbook
 import anthropic
 import csv
+from get_excel_sheets import read_sheet_names
+
+# Per-cell detail goes through logging so it costs nothing unless DEBUG is on
+logger = logging.getLogger(__name__)
+
+def json_loads(text):
+    """Parses JSON with orjson when installed, else the stdlib."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def json_dumps_indented(data):
+    """Serializes data as 2-space indented JSON with orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(data, indent=2)
+
+# COA analyses are cached here, keyed by file contents
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+
+# Invoice text stays in memory only: uploads are deleted after processing and
+# their contents must not outlive them on disk
+PDF_TEXT_MEMORY_CACHE_SIZE = 64
+pdf_text_memory_cache = {}
+pdf_text_cache_lock = threading.Lock()
+if fitz is not None:
+    PDF_TEXT_EXTRACTOR = 'pymupdf'
+elif pypdfium2 is not None:
+    PDF_TEXT_EXTRACTOR = 'pdfium'
+else:
+    PDF_TEXT_EXTRACTOR = 'pypdf2'
+
+def file_digest(file_path, salt=b''):
+    """Returns a 128-bit BLAKE2b hex digest of a file's contents, prefixed by salt."""
+    digest = hashlib.blake2b(salt, digest_size=16)
+    with open(file_path, 'rb') as f:
+        # Hash straight from the page cache; empty files can't be mapped
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+def write_cache_file(cache_path, data):
+    """Atomically writes bytes to a cache file; a failed write only costs a future miss."""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        safe_print(f"Could not write cache file {cache_path}: {str(e)}")
+
+def save_workbook(wb, excel_path):
+    """Saves a workbook through a temp file so a killed save never leaves a truncated file behind."""
+    temp_path = f"{excel_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        wb.save(temp_path)
+        os.replace(temp_path, excel_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 def extract_invoice_data(pdf_path):
-    """Extracts raw text from an invoice PDF for AI processing."""
-    with open(pdf_path, "rb") as file:
-        reader = PyPDF2.PdfReader(file)
-        text = "\n".join([page.extract_text() for page in reader.pages if page.extract_text()])
+    """Extracts raw text from an invoice PDF for AI processing, reusing cached text for identical files."""
+    # The extractor is part of the key since each library lays text out differently
+    cache_key = file_digest(pdf_path, PDF_TEXT_EXTRACTOR.encode())
+    text = pdf_text_memory_cache.get(cache_key)
+    if text is not None:
+        return text
+    
+    text = read_pdf_text(pdf_path)
+    with pdf_text_cache_lock:
+        if len(pdf_text_memory_cache) >= PDF_TEXT_MEMORY_CACHE_SIZE:
+            pdf_text_memory_cache.pop(next(iter(pdf_text_memory_cache)))
+        pdf_text_memory_cache[cache_key] = text
     return text
 
+def read_pdf_text(pdf_path):
+    """Parses the text of every page of a PDF."""
+    if fitz is not None:
+        with fitz.open(pdf_path) as doc:
+            pages = [doc[i].get_text("text") for i in range(doc.page_count)]
+    elif pypdfium2 is not None:
+        pdf = pypdfium2.PdfDocument(pdf_path)
+        try:
+            pages = [page.get_textpage().get_text_range() for page in pdf]
+        finally:
+            pdf.close()
+    else:
+        with open(pdf_path, "rb") as file:
+            reader = PyPDF2.PdfReader(file)
+            pages = [page.extract_text() for page in reader.pages]
+    return "\n".join(text for text in pages if text)
+
+# Analyses are cached by file content so re-uploads of the same COA skip the parse
+COA_CACHE_DIR = os.environ.get('COA_CACHE_DIR', CACHE_DIR)
+COA_CACHE_MAX_FILES = int(os.environ.get('COA_CACHE_MAX_FILES', 256))
+# Analyses hold the uploaded chart's rows, so they are removed this many seconds
+# after being written however often they are used
+COA_CACHE_TTL = int(os.environ.get('COA_CACHE_TTL', 24 * 60 * 60))
+COA_MEMORY_CACHE_SIZE = 16
+coa_memory_cache = {}
+
+# Digest of this module's source; a deploy that changes the analysis code
+# must not load analyses pickled by the previous version
+CODE_VERSION = file_digest(__file__)
+
+def coa_cache_key(excel_path, sheet_name):
+    """Hashes the workbook contents together with the sheet name and code version."""
+    return file_digest(excel_path, f"{CODE_VERSION}\0{sheet_name}".encode('utf-8'))
+
+def prune_cache_dir(directory, max_files, suffix, max_age):
+    """Removes cache files written more than max_age seconds ago, then the least
+    recently used ones beyond max_files.
+    
+    Files are expected to carry their write time as mtime and their last use as atime."""
+    cutoff = time.time() - max_age
+    try:
+        with os.scandir(directory) as it:
+            entries = [(entry.stat().st_atime, entry.stat().st_mtime, entry.path) for entry in it
+                       if entry.name.endswith(suffix) and entry.is_file()]
+    except OSError:
+        return
+    expired = [path for _, written, path in entries if written < cutoff]
+    entries = sorted(entry for entry in entries if entry[1] >= cutoff)
+    for _, _, path in entries[:max(0, len(entries) - max_files)]:
+        expired.append(path)
+    for path in expired:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Already removed by another process
+
 def analyze_excel_structure(excel_path, sheet_name="COA i-Kcal"):
-    """Reads and analyzes the Chart of Accounts structure from the Excel file."""
-    xls = pd.ExcelFile(excel_path)
-    if sheet_name not in xls.sheet_names:
-        raise ValueError(f"Sheet '{sheet_name}' not found in the provided Excel file.")
+    """Returns the COA sheet and its structure, reusing a cached analysis of identical files."""
+    cache_key = coa_cache_key(excel_path, sheet_name)
+    cached = coa_memory_cache.get(cache_key)
+    
+    if cached is None:
+        cache_path = os.path.join(COA_CACHE_DIR, f"{cache_key}.pkl")
+        try:
+            with open(cache_path, 'rb') as f:
+                written = os.fstat(f.fileno()).st_mtime
+                if time.time() - written < COA_CACHE_TTL:
+                    cached = pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            safe_print(f"Ignoring unreadable COA cache {cache_path}: {str(e)}")
+        
+        if cached is not None:
+            # Mark the hit in atime, keeping the write time in mtime for the TTL
+            try:
+                os.utime(cache_path, (time.time(), written))
+            except OSError:
+                pass
+        else:
+            cached = read_excel_structure(excel_path, sheet_name)
+            write_cache_file(cache_path, pickle.dumps(cached, protocol=pickle.HIGHEST_PROTOCOL))
+        prune_cache_dir(COA_CACHE_DIR, COA_CACHE_MAX_FILES, '.pkl', COA_CACHE_TTL)
+        
+        # The rendered prompt text is kept out of the pickle so prompt template
+        # changes apply at once; it is built once per memory-cache entry instead
+        cached[1]['prompt_context'] = build_coa_context(*cached)
+        
+        if len(coa_memory_cache) >= COA_MEMORY_CACHE_SIZE:
+            coa_memory_cache.pop(next(iter(coa_memory_cache)))
+        coa_memory_cache[cache_key] = cached
+    
+    # Hand out copies so callers can't modify the cached analysis
+    coa_sheet, structure = cached
+    return coa_sheet.copy(), copy.deepcopy(structure)
 
-    coa_sheet = pd.read_excel(xls, sheet_name=sheet_name)
+def open_excel_file(excel_path):
+    """Opens a workbook with the Rust-based calamine reader, falling back to openpyxl."""
+    import pandas as pd
+    try:
+        return pd.ExcelFile(excel_path, engine="calamine")
+    except (ImportError, ValueError):
+        # python-calamine missing or pandas too old to know the engine
+        return pd.ExcelFile(excel_path)
+
+def read_excel_structure(excel_path, sheet_name="COA i-Kcal"):
+    """Reads and analyzes the Chart of Accounts structure from the Excel file."""
+    import pandas as pd
+    # One open file serves both the sheet check and the read
+    with open_excel_file(excel_path) as xls:
+        if sheet_name not in xls.sheet_names:
+            raise ValueError(f"Sheet '{sheet_name}' not found in the provided Excel file.")
+        
+        coa_sheet = pd.read_excel(xls, sheet_name=sheet_name)
     coa_columns = coa_sheet.columns.tolist()
     
-    # Convert datetime columns to strings
-    for col in coa_columns:
-        if pd.api.types.is_datetime64_any_dtype(coa_sheet[col]):
-            coa_sheet[col] = coa_sheet[col].dt.strftime('%Y-%m-%d')
+    # Convert datetime columns to strings in one assignment
+    date_columns = coa_sheet.select_dtypes(include=['datetime', 'datetimetz']).columns
+    if len(date_columns):
+        coa_sheet[date_columns] = coa_sheet[date_columns].apply(lambda s: s.dt.strftime('%Y-%m-%d'))
     
     # Analyze column patterns and relationships
     column_patterns = {}
     column_relationships = {}
     column_hierarchy = {}
+    named_value_patterns = None
+    
+    # Columns are grouped by pattern type as they are classified
+    grouped_columns = {
+        'code_columns': [],
+        'numeric_columns': {'2-digit': [], '4-digit': [], 'decimal': []},
+        'text_columns': []
+    }
+    pattern_buckets = {
+        'code': grouped_columns['code_columns'],
+        '2-digit': grouped_columns['numeric_columns']['2-digit'],
+        '4-digit': grouped_columns['numeric_columns']['4-digit'],
+        'decimal': grouped_columns['numeric_columns']['decimal'],
+        'text': grouped_columns['text_columns']
+    }
     
     for col in coa_columns:
+        column = coa_sheet[col]
+        values = column.dropna().astype(str)
+        
         # Skip empty columns
-        if coa_sheet[col].isna().all():
+        if values.empty:
             continue
-            
-        # Analyze column content patterns
-        unique_values = coa_sheet[col].dropna().astype(str).unique()
+        
+        # Analyze column content patterns with vectorized string ops
+        example = values.iloc[0]
         
         # Check for code patterns
-        if any('-' in str(v) for v in unique_values):
-            column_patterns[col] = {'type': 'code', 'example': unique_values[0]}
+        if values.str.contains('-', regex=False).any():
+            column_patterns[col] = {'type': 'code', 'example': example}
             # Try to determine code hierarchy
-            code_parts = str(unique_values[0]).split('-')
+            code_parts = example.split('-')
             if len(code_parts) > 1:
                 column_hierarchy[col] = len(code_parts)
         
         # Check for numeric patterns
-        elif pd.api.types.is_numeric_dtype(coa_sheet[col]):
-            if all(len(str(v)) == 2 for v in unique_values if str(v).isdigit()):
-                column_patterns[col] = {'type': '2-digit', 'example': unique_values[0]}
-            elif all(len(str(v)) == 4 for v in unique_values if str(v).isdigit()):
-                column_patterns[col] = {'type': '4-digit', 'example': unique_values[0]}
-            elif any('.' in str(v) for v in unique_values):
-                column_patterns[col] = {'type': 'decimal', 'example': unique_values[0]}
+        elif pd.api.types.is_numeric_dtype(column):
+            # Only all-digit values count towards the fixed-width checks
+            digit_lengths = values[values.str.isdigit()].str.len().to_numpy()
+            if (digit_lengths == 2).all():
+                column_patterns[col] = {'type': '2-digit', 'example': example}
+            elif (digit_lengths == 4).all():
+                column_patterns[col] = {'type': '4-digit', 'example': example}
+            elif values.str.contains('.', regex=False).any():
+                column_patterns[col] = {'type': 'decimal', 'example': example}
         
         # Check for text patterns
         else:
-            column_patterns[col] = {'type': 'text', 'example': unique_values[0] if len(unique_values) > 0 else ''}
+            column_patterns[col] = {'type': 'text', 'example': example}
+        
+        if col in column_patterns:
+            pattern_buckets[column_patterns[col]['type']].append(col)
         
         # Analyze relationships between columns
         if 'Unnamed:' in str(col):
-            # Find the corresponding named column
-            for named_col in coa_columns:
-                if 'Unnamed:' not in str(named_col):
-                    # Check if values in unnamed column are derived from named column
-                    if not coa_sheet[col].isna().all() and not coa_sheet[named_col].isna().all():
-                        unnamed_values = coa_sheet[col].dropna().astype(str).unique()
+            if named_value_patterns is None:
+                # One alternation regex per named column, built once for all unnamed columns
+                named_value_patterns = {}
+                for named_col in coa_columns:
+                    if 'Unnamed:' not in str(named_col) and not coa_sheet[named_col].isna().all():
                         named_values = coa_sheet[named_col].dropna().astype(str).unique()
-                        if any(str(nv) in str(uv) for nv in named_values for uv in unnamed_values):
-                            column_relationships[col] = named_col
-                            break
-    
-    # Group columns by their patterns
-    grouped_columns = {
-        'code_columns': [col for col, pattern in column_patterns.items() if pattern['type'] == 'code'],
-        'numeric_columns': {
-            '2-digit': [col for col, pattern in column_patterns.items() if pattern['type'] == '2-digit'],
-            '4-digit': [col for col, pattern in column_patterns.items() if pattern['type'] == '4-digit'],
-            'decimal': [col for col, pattern in column_patterns.items() if pattern['type'] == 'decimal']
-        },
-        'text_columns': [col for col, pattern in column_patterns.items() if pattern['type'] == 'text']
-    }
+                        named_value_patterns[named_col] = re.compile('|'.join(map(re.escape, named_values)))
+            
+            # Find the corresponding named column: one whose values appear inside this column's values.
+            # Cell text can't contain NUL, so joining on it lets each regex scan every value in one call
+            # without a match spanning two values
+            joined_values = '\0'.join(values.unique())
+            for named_col, pattern in named_value_patterns.items():
+                if pattern.search(joined_values):
+                    column_relationships[col] = named_col
+                    break
     
     # Sort code columns by hierarchy
     if column_hierarchy:
@@ -112,34 +330,72 @@ def analyze_excel_structure(excel_path, sheet_name="COA i-Kcal"):
         'patterns': column_patterns,
         'grouped_columns': grouped_columns,
         'relationships': column_relationships,
-        'hierarchy': column_hierarchy
+        'hierarchy': column_hierarchy,
+        'classification_index': build_classification_index(coa_sheet)
     }
+    # Repetitive text columns (groups, names) become categoricals: the cached sheet
+    # stores each string once, and equality masks compare integer codes
+    for col in coa_sheet.select_dtypes(include=['object', 'string']).columns:
+        column = coa_sheet[col]
+        if column.nunique() <= len(column) // 2:
+            coa_sheet[col] = column.astype('category')
     
     return coa_sheet, structure
 
-def generate_account_code(coa_sheet, invoice_data):
+def find_code_column(columns):
+    """Returns the first column whose name mentions 'code'."""
+    for col in columns:
+        if 'code' in str(col).lower():
+            return col
+    return None
+
+def find_classification_columns(columns):
+    """Returns the group/classification columns, longest name (highest level) first."""
+    classification_columns = [col for col in columns
+                              if 'group' in str(col).lower() or 'classification' in str(col).lower()]
+    classification_columns.sort(key=lambda x: len(str(x)), reverse=True)
+    return classification_columns
+
+def build_classification_index(coa_sheet):
+    """Maps each full classification tuple to the code on its last row."""
+    code_column = find_code_column(coa_sheet.columns)
+    classification_columns = find_classification_columns(coa_sheet.columns)
+    if code_column is None or not classification_columns:
+        return {}
+    last_rows = coa_sheet.drop_duplicates(subset=classification_columns, keep='last')
+    return dict(zip(last_rows[classification_columns].itertuples(index=False, name=None),
+                    last_rows[code_column]))
+
+# Account type suffix keywords, checked in order; one regex scan per category
+MAIN_GROUP_SUFFIX_KEYWORDS = (
+    ('E', re.compile('EXPENSE|COST', re.IGNORECASE)),
+    ('L', re.compile('LIABILITY|REVENUE', re.IGNORECASE)),
+    ('A', re.compile('ASSET', re.IGNORECASE)),
+)
+INVOICE_TEXT_SUFFIX_KEYWORDS = (
+    ('E', re.compile('EXPENSE|COST|PAYMENT|BILL', re.IGNORECASE)),
+    ('L', re.compile('REVENUE|SALE|INCOME|RECEIPT', re.IGNORECASE)),
+    ('A', re.compile('ASSET|EQUIPMENT|MACHINE|PROPERTY', re.IGNORECASE)),
+)
+
+def generate_account_code(coa_sheet, invoice_data, structure=None):
     """
     Generates a new account code based on the financial classification from the invoice
     and existing patterns in the Chart of Accounts.
     """
+    import pandas as pd
     # Find the code column dynamically
-    code_column = None
-    for col in coa_sheet.columns:
-        if 'code' in str(col).lower():
-            code_column = col
-            break
+    code_column = find_code_column(coa_sheet.columns)
     
     if not code_column:
         raise ValueError("No code column found in the Excel sheet")
     
-    # Find the prefix pattern from existing codes
+    # Find the prefix pattern from the first existing code with a dash
     prefix_pattern = None
-    for _, row in coa_sheet.iterrows():
-        if not pd.isna(row[code_column]):
-            code_parts = str(row[code_column]).split('-')
-            if len(code_parts) >= 2:
-                prefix_pattern = code_parts[0]
-                break
+    codes = coa_sheet[code_column].dropna().astype(str)
+    dashed_codes = codes[codes.str.contains('-', regex=False)]
+    if not dashed_codes.empty:
+        prefix_pattern = dashed_codes.iloc[0].split('-')[0]
     
     if not prefix_pattern:
         raise ValueError("No existing code patterns found in the Excel sheet")
@@ -162,23 +418,20 @@ def generate_account_code(coa_sheet, invoice_data):
     
     # If no explicit account type, try to determine from MainGpCode
     if not account_suffix and 'MainGpCode' in invoice_data:
-        main_gp_code = invoice_data['MainGpCode'].upper()
-        if any(term in main_gp_code for term in ['EXPENSE', 'COST']):
-            account_suffix = 'E'
-        elif any(term in main_gp_code for term in ['LIABILITY', 'REVENUE']):
-            account_suffix = 'L'
-        elif any(term in main_gp_code for term in ['ASSET']):
-            account_suffix = 'A'
+        main_gp_code = invoice_data['MainGpCode']
+        for suffix, keywords in MAIN_GROUP_SUFFIX_KEYWORDS:
+            if keywords.search(main_gp_code):
+                account_suffix = suffix
+                break
     
     # If still no suffix, analyze invoice content
     if not account_suffix:
-        invoice_text = invoice_data.get('invoice_text', '').upper()
-        if any(term in invoice_text for term in ['EXPENSE', 'COST', 'PAYMENT', 'BILL']):
-            account_suffix = 'E'
-        elif any(term in invoice_text for term in ['REVENUE', 'SALE', 'INCOME', 'RECEIPT']):
-            account_suffix = 'L'
-        elif any(term in invoice_text for term in ['ASSET', 'EQUIPMENT', 'MACHINE', 'PROPERTY']):
-            account_suffix = 'A'
+        # The keyword patterns ignore case, so the (possibly long) text isn't upper-cased first
+        invoice_text = invoice_data.get('invoice_text', '')
+        for suffix, keywords in INVOICE_TEXT_SUFFIX_KEYWORDS:
+            if keywords.search(invoice_text):
+                account_suffix = suffix
+                break
     
     # If still no suffix, use the suffix from existing prefix pattern
     if not account_suffix:
@@ -187,14 +440,8 @@ def generate_account_code(coa_sheet, invoice_data):
     # Combine base prefix with determined suffix
     account_type = f"{base_prefix}{account_suffix}"
     
-    # Find the classification columns dynamically
-    classification_columns = []
-    for col in coa_sheet.columns:
-        if 'group' in str(col).lower() or 'classification' in str(col).lower():
-            classification_columns.append(col)
-    
-    # Sort columns to maintain hierarchy (primary, main, sub)
-    classification_columns.sort(key=lambda x: len(str(x)), reverse=True)
+    # Find the classification columns dynamically, sorted to maintain hierarchy (primary, main, sub)
+    classification_columns = find_classification_columns(coa_sheet.columns)
     
     # Extract classification components from invoice data
     classification_values = {}
@@ -225,13 +472,25 @@ def generate_account_code(coa_sheet, invoice_data):
     
     # If no invoice number, try to find matching rows and increment
     if not sequence_number:
-        matching_rows = coa_sheet.copy()
-        for col, value in classification_values.items():
-            if value:
-                matching_rows = matching_rows[matching_rows[col] == value]
+        last_code = None
+        classification_index = structure.get('classification_index') if structure else None
+        if classification_index is not None and all(classification_values.values()):
+            # Every level is known, so the prebuilt index answers with one lookup
+            key = tuple(classification_values[col] for col in classification_columns)
+            last_code = classification_index.get(key)
+            found = key in classification_index
+        else:
+            # Combine the known levels into one mask and select only the code column
+            mask = pd.Series(True, index=coa_sheet.index)
+            for col, value in classification_values.items():
+                if value:
+                    mask &= coa_sheet[col] == value
+            matching_codes = coa_sheet.loc[mask, code_column]
+            found = not matching_codes.empty
+            if found:
+                last_code = matching_codes.iloc[-1]
         
-        if not matching_rows.empty:
-            last_code = matching_rows[code_column].iloc[-1]
+        if found:
             code_parts = str(last_code).split('-')
             if len(code_parts) >= 5:
                 try:
@@ -258,13 +517,30 @@ def generate_account_code(coa_sheet, invoice_data):
     
     return new_code
 
+# Compiled once; this runs on every Claude response
+CODE_BLOCK_RE = re.compile(r'```(?:json)?\s*([\s\S]*?)```')
+
+def iter_json_objects(text):
+    """Yields each JSON object embedded in free text, left to right."""
+    # raw_decode parses from a given offset without regex backtracking; a failed
+    # attempt just moves on to the next opening brace
+    decoder = json.JSONDecoder()
+    pos = text.find('{')
+    while pos != -1:
+        try:
+            obj, end = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            pos = text.find('{', pos + 1)
+            continue
+        yield obj
+        pos = text.find('{', end)
+
 def extract_first_json(text):
     """Extracts the first JSON object or array from a text string."""
     safe_print("Extracting JSON from text...")
     
     # Look for JSON content within markdown code blocks first
-    code_block_pattern = r'```(?:json)?\s*([\s\S]*?)```'
-    code_blocks = re.findall(code_block_pattern, text)
+    code_blocks = CODE_BLOCK_RE.findall(text)
     
     if code_blocks:
         # Try each code block until we find valid JSON
@@ -278,7 +554,7 @@ def extract_first_json(text):
                 try:
                     # Wrap in array brackets and try to parse
                     wrapped_json = '[' + json_text + ']'
-                    result = json.loads(wrapped_json)
+                    result = json_loads(wrapped_json)
                     safe_print("Successfully wrapped JSON in array brackets.")
                     return result
                 except json.JSONDecodeError as e:
@@ -286,7 +562,7 @@ def extract_first_json(text):
             
             # Try to parse the block directly
             try:
-                result = json.loads(json_text)
+                result = json_loads(json_text)
                 safe_print("JSON successfully extracted.")
                 return result
             except json.JSONDecodeError as e:
@@ -295,42 +571,38 @@ def extract_first_json(text):
     # If we reached here, we couldn't parse code blocks properly
     # Try to find and extract multiple JSON objects and wrap them in an array
     safe_print("Looking for JSON objects in the entire text...")
-    objects = re.findall(r'\{[^\{\}]*(?:\{[^\{\}]*\}[^\{\}]*)*\}', text)
+    objects = list(iter_json_objects(text))
     
-    if objects and len(objects) > 1:
-        wrapped_json = "[" + ",".join(objects) + "]"
-        try:
-            safe_print("Trying to parse with manual array wrapping...")
-            return json.loads(wrapped_json)
-        except json.JSONDecodeError as e:
-            safe_print(f"Failed with array wrapping approach: {e}")
-    elif objects and len(objects) == 1:
-        try:
-            safe_print("Found a single JSON object in the text.")
-            return json.loads(objects[0])
-        except json.JSONDecodeError as e:
-            safe_print(f"Failed to parse single object: {e}")
+    if len(objects) > 1:
+        safe_print(f"Found {len(objects)} JSON objects in the text.")
+        return objects
+    elif len(objects) == 1:
+        safe_print("Found a single JSON object in the text.")
+        return objects[0]
     
     # If all attempts failed
     safe_print("ERROR: No valid JSON found in response.")
     raise ValueError("No valid JSON found in the response")
 
-def construct_prompt(coa_sheet, structure, invoice_text):
-    """Constructs a well-structured prompt for Claude, ensuring correct financial classification."""
+# Rows of the COA sent verbatim; the examples and format rules carry the rest
+COA_PREVIEW_ROWS = 20
+
+def coa_preview(coa_sheet):
+    """Picks up to COA_PREVIEW_ROWS rows, one per classification group where the sheet has groups."""
+    # The first rows of a COA usually all belong to one group; sampling across
+    # groups shows Claude more of the code patterns for the same tokens
+    classification_columns = find_classification_columns(coa_sheet.columns)
+    if classification_columns:
+        return coa_sheet.drop_duplicates(subset=classification_columns).head(COA_PREVIEW_ROWS)
+    return coa_sheet.head(COA_PREVIEW_ROWS)
+
+def build_coa_context(coa_sheet, structure):
+    """Builds the part of the classification prompt that depends only on the COA, not the invoice."""
     
-    # Get example rows from the Excel sheet and convert to string format
-    example_rows = []
-    for _, row in coa_sheet.head(5).iterrows():
-        row_dict = {}
-        for col in structure['columns']:
-            value = row[col]
-            if pd.isna(value):
-                row_dict[col] = ""
-            elif isinstance(value, (pd.Timestamp, datetime)):
-                row_dict[col] = value.strftime('%Y-%m-%d')
-            else:
-                row_dict[col] = str(value)
-        example_rows.append(row_dict)
+    # Get example rows from the Excel sheet as strings; datetime columns were
+    # already formatted when the structure was analyzed
+    preview = coa_sheet.head(5)[structure['columns']]
+    example_rows = preview.astype(str).mask(preview.isna(), "").to_dict(orient='records')
     
     # Create format requirements based on the analyzed structure
     format_requirements = []
@@ -362,21 +634,18 @@ def construct_prompt(coa_sheet, structure, invoice_text):
         for unnamed_col, named_col in structure['relationships'].items():
             format_requirements.append(f"- {unnamed_col}: Values should be derived from {named_col}")
     
-    prompt = f"""
-    You are an AI accountant. Analyze this invoice and provide a complete financial classification.
-    The classification must include ALL columns from the Chart of Accounts, with proper formatting for each.
-
-    **Invoice Text:**
-    {invoice_text}
+    preview_rows = coa_preview(coa_sheet)
+    
+    return f"""
 
-    **Chart of Accounts sheet:**
-    {coa_sheet}
+    **Chart of Accounts sheet ({len(preview_rows)} sample rows of {len(coa_sheet)}):**
+    {preview_rows.to_string()}
 
     **Required Column Formats:**
     {chr(10).join(format_requirements)}
 
     **Example Rows from Chart of Accounts:**
-    {json.dumps(example_rows, indent=2)}
+    {json_dumps_indented(example_rows)}
 
     balance_sheet_structure = 
     VERTICAL BALANCE SHEET FORMAT:
@@ -429,11 +698,24 @@ def construct_prompt(coa_sheet, structure, invoice_text):
 
     Provide the classification in JSON format with ALL columns from the example rows.
     """
+
+def construct_prompt(coa_sheet, structure, invoice_text):
+    """Constructs a well-structured prompt for Claude, ensuring correct financial classification."""
+    # The COA part is the same for every invoice; it is built once per analysis and kept in the structure
+    coa_context = structure.get('prompt_context')
+    if coa_context is None:
+        coa_context = structure['prompt_context'] = build_coa_context(coa_sheet, structure)
     
-    return prompt
+    return f"""
+    You are an AI accountant. Analyze this invoice and provide a complete financial classification.
+    The classification must include ALL columns from the Chart of Accounts, with proper formatting for each.
+
+    **Invoice Text:**
+    {invoice_text}{coa_context}"""
 
 def analyze_code_patterns(coa_sheet, structure):
     """Analyzes and returns patterns in the Code column to help Claude understand structure."""
+    import pandas as pd
     code_examples = {}
     
     # Find the code column dynamically
@@ -464,36 +746,185 @@ def analyze_code_patterns(coa_sheet, structure):
     
     return patterns_text
 
-def classify_invoice_with_claude(invoice_text, coa_sheet, structure, api_key):
-    """Uses Claude API to classify invoice data and match it to the Chart of Accounts."""
-    # Get the structure analysis
-    prompt = construct_prompt(coa_sheet, structure, invoice_text)
+def format_fixed_width(value, width):
+    """Formats an integer or decimal value as a zero-padded integer."""
+    text = str(value)
+    number = int(float(text)) if '.' in text else int(text)
+    return f"{number:0{width}d}"
 
-    safe_print("\nSending prompt to Claude API...")
-    
-    # Set a system prompt specifically requesting JSON response
-    system_prompt = """
+# Formatters for the numeric column patterns found by analyze_excel_structure
+VALUE_FORMATTERS = {
+    '2-digit': lambda value: format_fixed_width(value, 2),
+    '4-digit': lambda value: format_fixed_width(value, 4),
+    'decimal': lambda value: f"{float(str(value)):.1f}",
+}
+
+# Set a system prompt specifically requesting JSON response
+CLASSIFY_SYSTEM_PROMPT = """
     You are a financial analysis assistant. When producing JSON output:
     1. Always enclose the entire JSON in a code block with ```json and ``` markers
     2. Ensure the JSON is well-formed and valid
     3. Provide a single JSON object, not an array of objects
     4. Follow the exact schema requested by the user
     """
-    
-    # Call the Claude API
-    client = anthropic.Anthropic(api_key=api_key)
-    message = client.messages.create(
-        model="claude-3-opus-20240229",
-        max_tokens=4000,
-        temperature=0,
-        system=system_prompt,
-        messages=[
+
+# System prompt for classifying several invoices in one request
+BATCH_CLASSIFY_SYSTEM_PROMPT = """
+    You are a financial analysis assistant. When producing JSON output:
+    1. Always enclose the entire JSON in a code block with ```json and ``` markers
+    2. Ensure the JSON is well-formed and valid
+    3. Provide a JSON array with exactly one object per invoice, in the order the invoices are given
+    4. Follow the exact schema requested by the user for every object
+    """
+
+# Invoices sharing one prompt in process_pdfs; 1 sends each invoice on its own,
+# concurrently. Accuracy drops as batches grow, so keep this small
+CLAUDE_BATCH_SIZE = int(os.environ.get('CLAUDE_BATCH_SIZE', 1))
+
+# Upper bound on simultaneous Claude requests when classifying a batch
+CLAUDE_MAX_CONCURRENCY = int(os.environ.get('CLAUDE_MAX_CONCURRENCY', 4))
+
+# The SDK retries rate limits (429), overloads, 5xx and timeouts with exponential
+# backoff and jitter; concurrent batches hit rate limits more often than the default 2 retries cover
+CLAUDE_MAX_RETRIES = int(os.environ.get('CLAUDE_MAX_RETRIES', 5))
+
+@functools.lru_cache(maxsize=4)
+def get_claude_client(api_key):
+    """Returns a shared Claude client per API key so its connection pool is reused."""
+    return anthropic.Anthropic(api_key=api_key, max_retries=CLAUDE_MAX_RETRIES)
+
+def classification_request(invoice_text, coa_sheet, structure):
+    """Builds the Claude messages.create arguments for one invoice."""
+    return {
+        'model': "claude-3-opus-20240229",
+        'max_tokens': 4000,
+        'temperature': 0,
+        'system': CLASSIFY_SYSTEM_PROMPT,
+        'messages': [
+            {"role": "user", "content": construct_prompt(coa_sheet, structure, invoice_text)}
+        ]
+    }
+
+def batch_classification_request(invoice_texts, coa_sheet, structure):
+    """Builds the Claude messages.create arguments for several invoices sharing one COA prompt."""
+    numbered_invoices = "\n\n".join(f"--- Invoice {number} ---\n{invoice_text}"
+                                     for number, invoice_text in enumerate(invoice_texts, 1))
+    prompt = construct_prompt(coa_sheet, structure, numbered_invoices)
+    prompt += (f"\n    The invoice text above contains {len(invoice_texts)} separate invoices. "
+               f"Classify each one on its own and return a JSON array of exactly {len(invoice_texts)} "
+               "objects, one per invoice, in invoice order.\n")
+    return {
+        'model': "claude-3-opus-20240229",
+        'max_tokens': 4096,
+        'temperature': 0,
+        'system': BATCH_CLASSIFY_SYSTEM_PROMPT,
+        'messages': [
             {"role": "user", "content": prompt}
         ]
-    )
+    }
+
+def classify_invoice_with_claude(invoice_text, coa_sheet, structure, api_key):
+    """Uses Claude API to classify invoice data and match it to the Chart of Accounts."""
+    request = classification_request(invoice_text, coa_sheet, structure)
+
+    safe_print("\nSending prompt to Claude API...")
+    
+    # Call the Claude API
+    message = get_claude_client(api_key).messages.create(**request)
+    
+    return parse_classification(message.content[0].text, structure)
+
+def classify_invoices_with_claude(invoice_texts, coa_sheet, structure, api_key, batch_size=CLAUDE_BATCH_SIZE):
+    """Classifies invoices several per Claude call, so the COA context is sent once per batch."""
+    # CLAUDE_BATCH_SIZE comes from the environment; 0 or less means one invoice per call
+    batch_size = max(1, batch_size)
+    client = get_claude_client(api_key)
+    results = []
+    for start in range(0, len(invoice_texts), batch_size):
+        batch = invoice_texts[start:start + batch_size]
+        if len(batch) == 1:
+            results.append(classify_invoice_with_claude(batch[0], coa_sheet, structure, api_key))
+            continue
+        
+        safe_print(f"\nSending {len(batch)} invoices to Claude API in one prompt...")
+        message = client.messages.create(**batch_classification_request(batch, coa_sheet, structure))
+        try:
+            results.extend(parse_batch_classification(message.content[0].text, structure, len(batch)))
+        except ValueError as e:
+            # A short or malformed answer costs this batch its saving, not its results
+            safe_print(f"Batch answer unusable ({str(e).splitlines()[0]}); classifying one by one")
+            results.extend(classify_invoice_with_claude(invoice_text, coa_sheet, structure, api_key)
+                           for invoice_text in batch)
+    return results
+
+# Seconds between status checks while a Message Batch is processed
+MESSAGE_BATCH_POLL_INTERVAL = 30
+# Seconds to wait for a Message Batch before cancelling it
+MESSAGE_BATCH_MAX_WAIT = int(os.environ.get('MESSAGE_BATCH_MAX_WAIT', 24 * 60 * 60))
+
+def classify_invoices_with_message_batches(invoice_texts, coa_sheet, structure, api_key,
+                                           poll_interval=MESSAGE_BATCH_POLL_INTERVAL,
+                                           max_wait=MESSAGE_BATCH_MAX_WAIT):
+    """Classifies invoices through the asynchronous Message Batches API; for bulk runs, not interactive use.
+    
+    Raises TimeoutError, after cancelling the batch, if it hasn't ended within max_wait seconds."""
+    client = get_claude_client(api_key)
+    batch = client.messages.batches.create(requests=[
+        {'custom_id': f"invoice-{index}", 'params': classification_request(invoice_text, coa_sheet, structure)}
+        for index, invoice_text in enumerate(invoice_texts)
+    ])
+    safe_print(f"\nSubmitted {len(invoice_texts)} invoices as message batch {batch.id}")
+    
+    deadline = time.monotonic() + max_wait
+    while batch.processing_status != 'ended':
+        if time.monotonic() >= deadline:
+            client.messages.batches.cancel(batch.id)
+            raise TimeoutError(f"Message batch {batch.id} did not finish within {max_wait} seconds; cancelled it")
+        time.sleep(poll_interval)
+        batch = client.messages.batches.retrieve(batch.id)
+    
+    results = [None] * len(invoice_texts)
+    for entry in client.messages.batches.results(batch.id):
+        index = int(entry.custom_id.rsplit('-', 1)[1])
+        if entry.result.type == 'succeeded':
+            try:
+                results[index] = parse_classification(entry.result.message.content[0].text, structure)
+            except ValueError as e:
+                safe_print(f"Batch request {entry.custom_id} answer unusable ({str(e).splitlines()[0]}); retrying it directly")
+        else:
+            safe_print(f"Batch request {entry.custom_id} {entry.result.type}; retrying it directly")
+    
+    # Errored or expired requests are retried in real time so every invoice gets a row
+    for index, result in enumerate(results):
+        if result is None:
+            results[index] = classify_invoice_with_claude(invoice_texts[index], coa_sheet, structure, api_key)
+    return results
+
+async def classify_invoices_async(invoice_texts, coa_sheet, structure, api_key, max_concurrency=CLAUDE_MAX_CONCURRENCY):
+    """Classifies several invoices concurrently over one async Claude client.
     
-    response_text = message.content[0].text
+    A failed invoice's entry is the exception it raised, so one bad answer doesn't lose the rest."""
+    semaphore = asyncio.Semaphore(max_concurrency)
     
+    async with anthropic.AsyncAnthropic(api_key=api_key, max_retries=CLAUDE_MAX_RETRIES) as client:
+        async def classify(invoice_text):
+            async with semaphore:
+                return await classify_invoice_with_claude_async(invoice_text, coa_sheet, structure, client)
+        
+        return await asyncio.gather(*(classify(invoice_text) for invoice_text in invoice_texts),
+                                    return_exceptions=True)
+
+async def classify_invoice_with_claude_async(invoice_text, coa_sheet, structure, client):
+    """Async counterpart of classify_invoice_with_claude over a shared AsyncAnthropic client."""
+    request = classification_request(invoice_text, coa_sheet, structure)
+    
+    safe_print("\nSending prompt to Claude API...")
+    message = await client.messages.create(**request)
+    
+    return parse_classification(message.content[0].text, structure)
+
+def parse_classification(response_text, structure):
+    """Extracts Claude's JSON answer and formats it to match the Chart of Accounts columns."""
     # Use our safe_print for Claude's response that might contain Unicode characters
     try:
         safe_print("\nClaude Response (Preview): " + response_text[:100] + "...")
@@ -511,48 +942,112 @@ def classify_invoice_with_claude(invoice_text, coa_sheet, structure, api_key):
         else:
             item_data = extracted_data
             
-        # Ensure all required columns are present and properly formatted
-        final_data = {}
-        for col in structure['columns']:
-            # Get the value directly from extracted_data
-            value = item_data.get(col, "")
-            
-            # Apply formatting based on column type
-            if col in structure['patterns']:
-                pattern = structure['patterns'][col]
-                try:
-                    if pattern['type'] == '2-digit' and value:
-                        # Handle both integer and decimal values
-                        if '.' in str(value):
-                            value = f"{int(float(str(value))):02d}"
-                        else:
-                            value = f"{int(str(value)):02d}"
-                    elif pattern['type'] == '4-digit' and value:
-                        # Handle both integer and decimal values
-                        if '.' in str(value):
-                            value = f"{int(float(str(value))):04d}"
-                        else:
-                            value = f"{int(str(value)):04d}"
-                    elif pattern['type'] == 'decimal' and value:
-                        # Ensure decimal format
-                        value = f"{float(str(value)):.1f}"
-                except (ValueError, TypeError) as e:
-                    safe_print(f"Warning: Could not format value '{value}' for column '{col}': {str(e)}")
-                    # Keep original value if formatting fails
-                    pass
-            
-            # Store the value in final_data
-            final_data[col] = value
-        
+        final_data = format_classification(item_data, structure)
         safe_print("\nFinal Data to be inserted: [Data prepared successfully]")
         return final_data
 
     except Exception as e:
         raise ValueError(f"Error processing Claude's response: {str(e)}\nRaw output:\n{response_text}")
 
+def parse_batch_classification(response_text, structure, count):
+    """Extracts Claude's JSON array for a batch and formats one row per invoice."""
+    try:
+        extracted_data = extract_first_json(response_text)
+    except Exception as e:
+        raise ValueError(f"Error processing Claude's response: {str(e)}\nRaw output:\n{response_text}")
+    
+    if not isinstance(extracted_data, list) or len(extracted_data) != count:
+        found = len(extracted_data) if isinstance(extracted_data, list) else 1
+        raise ValueError(f"Expected {count} classifications, got {found}\nRaw output:\n{response_text}")
+    if not all(isinstance(item_data, dict) for item_data in extracted_data):
+        raise ValueError(f"Expected a JSON object per invoice\nRaw output:\n{response_text}")
+    
+    return [format_classification(item_data, structure) for item_data in extracted_data]
+
+def format_classification(item_data, structure):
+    """Formats one classified invoice to match the Chart of Accounts columns."""
+    # Ensure all required columns are present and properly formatted
+    column_formatters = {col: VALUE_FORMATTERS[pattern['type']]
+                         for col, pattern in structure['patterns'].items()
+                         if pattern['type'] in VALUE_FORMATTERS}
+    final_data = {}
+    for col in structure['columns']:
+        # Get the value directly from extracted_data
+        value = item_data.get(col, "")
+        
+        # Apply formatting based on column type
+        formatter = column_formatters.get(col)
+        if formatter and value:
+            try:
+                value = formatter(value)
+            except (ValueError, TypeError) as e:
+                safe_print(f"Warning: Could not format value '{value}' for column '{col}': {str(e)}")
+                # Keep original value if formatting fails
+                pass
+        
+        # Store the value in final_data
+        final_data[col] = value
+    
+    return final_data
+
+# openpyxl workbooks are not thread-safe, so writes to the output file are serialized
+excel_write_lock = threading.Lock()
+
+def process_pdfs(excel_path, pdf_paths, sheet_name="COA i-Kcal", api_key=None, existing_file_path=None, max_workers=8,
+                 batch_mode=False, batch_size=CLAUDE_BATCH_SIZE):
+    """Classifies several invoice PDFs concurrently and appends them to one Excel file.
+
+    With batch_mode the classifications go through the Message Batches API, which is
+    cheaper for large offline runs but can take minutes to hours to complete.
+    Otherwise a batch_size above 1 sends that many invoices per prompt, so the COA
+    context is paid for once per group instead of once per invoice.
+    Invoices whose classification fails are reported and left out; if none succeed,
+    the first failure is raised.
+    """
+    # The structure is analyzed once and shared read-only by every classification
+    coa_sheet, structure = analyze_excel_structure(excel_path, sheet_name)
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pdf_paths)))) as pool:
+        invoice_texts = list(pool.map(extract_invoice_data, pdf_paths))
+    
+    # Both paths keep results in input order, so rows land in the order the PDFs were given
+    if batch_mode:
+        rows = classify_invoices_with_message_batches(invoice_texts, coa_sheet, structure, api_key)
+    elif batch_size > 1:
+        rows = classify_invoices_with_claude(invoice_texts, coa_sheet, structure, api_key, batch_size)
+    else:
+        rows = asyncio.run(classify_invoices_async(invoice_texts, coa_sheet, structure, api_key))
+    
+    failures = [(pdf_path, row) for pdf_path, row in zip(pdf_paths, rows) if isinstance(row, BaseException)]
+    for pdf_path, error in failures:
+        safe_print(f"Skipping {pdf_path}: {(str(error) or type(error).__name__).splitlines()[0]}")
+    rows = [row for row in rows if not isinstance(row, BaseException)]
+    if not rows:
+        raise failures[0][1]
+    safe_print(f"Classified {len(rows)} invoices")
+    
+    # One workbook load and save for the whole batch
+    with excel_write_lock:
+        return update_excel_with_rows(excel_path, sheet_name, rows, existing_file_path)
+
+def process(coa_path, invoice_paths, sheet_name=None, existing_path=None):
+    """Processes a list of invoice PDFs in-process and returns the updated Excel path."""
+    api_key = os.environ.get('ANTHROPIC_API_KEY')
+    if not api_key:
+        raise ValueError("ANTHROPIC_API_KEY environment variable not set")
+    
+    # A lone path is one invoice; it is never split, so any filename is valid
+    if isinstance(invoice_paths, (str, os.PathLike)):
+        invoice_paths = [invoice_paths]
+    return process_pdfs(coa_path, list(invoice_paths), sheet_name or "COA i-Kcal", api_key, existing_path)
+
 def update_excel_with_data(excel_path, sheet_name, data, existing_file_path=None):
     """Updates the existing Excel file with new data and saves a copy.
     If existing_file_path is provided, appends to that file instead of creating a new one."""
+    return update_excel_with_rows(excel_path, sheet_name, [data], existing_file_path)
+
+def update_excel_with_rows(excel_path, sheet_name, rows, existing_file_path=None):
+    """Appends several rows of data to a copy of the Excel file with a single load and save."""
     try:
         # Create output directory for processed files
         output_dir = os.path.join(os.path.dirname(excel_path), "processed_output")
@@ -585,15 +1080,16 @@ def update_excel_with_data(excel_path, sheet_name, data, existing_file_path=None
         except Exception as e:
             safe_print(f"Error copying Excel file: {str(e)}")
             # If copying fails, try creating a new Excel file as fallback
-            return create_new_excel_file(output_path, data)
+            return create_new_excel_file(output_path, rows)
         
-        # Try to load the workbook
+        # Try to load the workbook. A full (not read_only/write_only) load is required:
+        # saving must keep the other sheets, styles and macros of the original file
         try:
             wb = load_workbook(output_path, keep_vba=True)
         except Exception as wb_error:
             safe_print(f"Error loading workbook: {str(wb_error)}")
             # If loading fails, try creating a new Excel file as fallback
-            return create_new_excel_file(output_path, data)
+            return create_new_excel_file(output_path, rows)
         
         # Try to use the specified sheet name, fallback to active sheet if not found
         try:
@@ -615,7 +1111,7 @@ def update_excel_with_data(excel_path, sheet_name, data, existing_file_path=None
             # Get the next empty row
             new_row = last_row + 1
             safe_print(f"Last filled row: {last_row}")
-            safe_print(f"Adding new data to row: {new_row}")
+            safe_print(f"Adding {len(rows)} row(s) starting at row: {new_row}")
         except Exception as row_error:
             safe_print(f"Error finding last row: {str(row_error)}")
             new_row = ws.max_row + 1
@@ -625,112 +1121,107 @@ def update_excel_with_data(excel_path, sheet_name, data, existing_file_path=None
         try:
             headers = {}
             for idx, cell in enumerate(ws[1], 1):
-                col_letter = get_column_letter(idx)
                 header = cell.value
                 if header is None:
                     # For unnamed columns, use the format "Unnamed: {index}"
                     header = f"Unnamed: {idx-1}"
-                headers[header] = col_letter
+                headers[header] = idx
             
             safe_print("Excel Headers:", list(headers.keys()))
         except Exception as header_error:
             safe_print(f"Error getting headers: {str(header_error)}")
             # Create simple headers if needed
             headers = {}
-            for idx, key in enumerate(data.keys(), 1):
-                headers[key] = get_column_letter(idx)
+            for idx, key in enumerate(rows[0].keys(), 1):
+                headers[key] = idx
         
-        # Update each column with the values from data
-        for header, col_letter in headers.items():
-            # Try to find a matching value in the data
-            value = None
-            
-            # First try exact match
-            if header in data:
-                value = data[header]
+        # Work out once per batch how each column is filled; only the lookups vary per row
+        today = datetime.now().strftime('%Y-%m-%d')
+        named_headers = [header for header in headers if 'unnamed' not in str(header).lower()]
+        column_plan = []
+        for header, col_idx in headers.items():
+            header_lower = str(header).lower()
+            # If no match is found, infer the value from the column name
+            if any(date_term in header_lower for date_term in ['date', 'time', 'period']):
+                default = today
+            elif any(amount_term in header_lower for amount_term in ['amount', 'value', 'total', 'sum']):
+                default = '0.00'
+            elif any(code_term in header_lower for code_term in ['code', 'id', 'number']):
+                default = '0000'
             else:
-                # Try case-insensitive match
-                for data_key in data.keys():
-                    if str(header).lower() == str(data_key).lower():
-                        value = data[data_key]
-                        break
+                default = None
+            # Unnamed columns without a default take the first named column's value
+            from_named = default is None and 'unnamed' in header_lower
+            column_plan.append((header, header_lower, col_idx, default, from_named))
+        
+        for data in rows:
+            # Case-insensitive lookup table; the first key wins, as with a linear search
+            data_lower = {}
+            for data_key, data_value in data.items():
+                data_lower.setdefault(str(data_key).lower(), data_value)
             
-            # If no match found, try to infer value based on column name and data
-            if value is None:
-                # Check for date columns
-                if any(date_term in str(header).lower() for date_term in ['date', 'time', 'period']):
-                    value = datetime.now().strftime('%Y-%m-%d')
-                
-                # Check for amount/value columns
-                elif any(amount_term in str(header).lower() for amount_term in ['amount', 'value', 'total', 'sum']):
-                    value = '0.00'
-                
-                # Check for code columns
-                elif any(code_term in str(header).lower() for code_term in ['code', 'id', 'number']):
-                    value = '0000'
-                
-                # For unnamed columns, try to find a value from a related named column
-                elif 'unnamed' in str(header).lower():
-                    for named_col in headers:
-                        if 'unnamed' not in str(named_col).lower():
-                            if named_col in data:
-                                value = data[named_col]
-                                break
+            # Update each column with the values from data
+            for header, header_lower, col_idx, default, from_named in column_plan:
+                # First try exact match, then case-insensitive match
+                value = data[header] if header in data else data_lower.get(header_lower)
             
-            # If still no value, use empty string
-            if value is None:
-                value = ""
+                if value is None:
+                    if from_named:
+                        value = next((data[named_col] for named_col in named_headers if named_col in data), None)
+                    else:
+                        value = default
             
-            # Set the value in the Excel sheet
-            try:
-                safe_print(f"Setting {col_letter}{new_row} ({header}) = {value}")
-                ws[f"{col_letter}{new_row}"] = value
-            except Exception as cell_error:
-                safe_print(f"Error setting cell {col_letter}{new_row}: {str(cell_error)}")
+                # If still no value, use empty string
+                if value is None:
+                    value = ""
+            
+                # Set the value in the Excel sheet
+                try:
+                    logger.debug("Setting row %s, column %s (%s) = %s", new_row, col_idx, header, value)
+                    ws.cell(row=new_row, column=col_idx, value=value)
+                except Exception as cell_error:
+                    safe_print(f"Error setting row {new_row}, column {col_idx}: {str(cell_error)}")
+        
+            new_row += 1
         
         # Save the workbook to the new location
         try:
             safe_print(f"Saving updated Excel file to: {output_path}")
-            wb.save(output_path)
+            save_workbook(wb, output_path)
             safe_print(f"Saved to: {output_path}")
-            safe_print(f"\n✅ Successfully updated row {new_row} in the Excel file")
+            safe_print(f"\n✅ Successfully added {len(rows)} row(s) to the Excel file")
         except Exception as save_error:
             safe_print(f"Error saving workbook: {str(save_error)}")
             # If saving fails, try creating a new Excel file as fallback
-            return create_new_excel_file(output_path, data)
+            return create_new_excel_file(output_path, rows)
         
         return output_path  # Return the path of the saved file
     
     except Exception as e:
         safe_print(f"Error updating Excel: {str(e)}")
         # Try creating a new Excel file as a last resort
-        return create_new_excel_file(output_path, data)
+        return create_new_excel_file(output_path, rows)
 
 def create_new_excel_file(output_path, data):
     """Creates a new Excel file as a fallback when updating fails."""
+    rows = [data] if isinstance(data, dict) else list(data)
     try:
         safe_print("Attempting to create new Excel file as fallback...")
-        # Create a new Excel file from scratch
+        # Create a new Excel file from scratch; write-only mode streams rows
+        # straight to the file instead of building a Cell object per value
         from openpyxl import Workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Processed Invoice"
-        
-        # Add headers in the first row
-        headers = list(data.keys())
-        for col_idx, header in enumerate(headers, 1):
-            col_letter = get_column_letter(col_idx)
-            ws[f"{col_letter}1"] = header
-            
-        # Add data in the second row
-        for col_idx, header in enumerate(headers, 1):
-            col_letter = get_column_letter(col_idx)
-            value = data[header]
-            ws[f"{col_letter}2"] = value
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Processed Invoice")
+        
+        # Add headers in the first row, then one row per record
+        headers = list(rows[0].keys())
+        ws.append(headers)
+        for row in rows:
+            ws.append([row.get(header) for header in headers])
         
         # Save the workbook to the new location
-        new_output_path = output_path.replace('.xlsm', '.xlsx').replace('.xls', '.xlsx')
-        wb.save(new_output_path)
+        new_output_path = os.path.splitext(output_path)[0] + '.xlsx'
+        save_workbook(wb, new_output_path)
         safe_print(f"Saved new Excel file to: {new_output_path}")
         safe_print(f"Saved to: {new_output_path}")
         return new_output_path
@@ -738,20 +1229,30 @@ def create_new_excel_file(output_path, data):
         safe_print(f"Error creating fallback Excel file: {str(e)}")
         raise
 
-def update_chart_of_accounts(excel_path, invoice_data, sheet_name="COA i-Kcal"):
+def to_number(value):
+    """Converts a value to float if it has a decimal point, else to int."""
+    # Values that are already numbers (e.g. the fallback invoice) pass straight through
+    if type(value) in (int, float):
+        return value
+    return float(value) if '.' in str(value) else int(value)
+
+def update_chart_of_accounts(excel_path, invoice_data, sheet_name="COA i-Kcal", wb=None):
     """
     Updates the Chart of Accounts Excel sheet with extracted invoice data.
     
     Args:
         excel_path (str): Path to the Excel file to update
-        invoice_data (dict): Dictionary containing the invoice data to add
+        invoice_data (dict or list): Invoice data to add, or a list of them to add
+            as consecutive rows with a single save
         sheet_name (str): Name of the sheet to update (default: 'COA i-Kcal')
+        wb (Workbook, optional): Workbook already loaded from excel_path; it is
+            saved and closed here just like one loaded by this function
         
     Returns:
         bool: True if update was successful, False otherwise
         
     Raises:
-        ValueError: If invoice_data is not a dictionary or is empty
+        ValueError: If invoice_data is not a dictionary (or list of them) or is empty
         FileNotFoundError: If the Excel file doesn't exist
         PermissionError: If the Excel file is read-only
         Exception: For any other errors during the update process
@@ -761,38 +1262,33 @@ def update_chart_of_accounts(excel_path, invoice_data, sheet_name="COA i-Kcal"):
     safe_print(f"Sheet Name: {sheet_name}")
     
     # Validate invoice_data
-    if not isinstance(invoice_data, dict):
-        error_msg = f"invoice_data must be a dictionary, got {type(invoice_data).__name__}"
-        safe_print(f"❌ {error_msg}")
-        safe_print(f"invoice_data value: {invoice_data}")
-        raise ValueError(error_msg)
+    rows = invoice_data if isinstance(invoice_data, list) else [invoice_data]
+    for row_data in rows:
+        if not isinstance(row_data, dict):
+            error_msg = f"invoice_data must be a dictionary, got {type(row_data).__name__}"
+            safe_print(f"❌ {error_msg}")
+            safe_print(f"invoice_data value: {row_data}")
+            raise ValueError(error_msg)
+        
+        if not row_data:
+            error_msg = "invoice_data dictionary is empty"
+            safe_print(f"❌ {error_msg}")
+            raise ValueError(error_msg)
     
-    if not invoice_data:
-        error_msg = "invoice_data dictionary is empty"
+    if not rows:
+        error_msg = "invoice_data list is empty"
         safe_print(f"❌ {error_msg}")
         raise ValueError(error_msg)
     
-    safe_print("Invoice data keys:", list(invoice_data.keys()))
-    safe_print("Invoice data values:", list(invoice_data.values()))
-    
-    wb = None  # Initialize wb variable for use in finally block
+    safe_print(f"Invoice rows to add: {len(rows)}")
+    for row_data in rows:
+        logger.debug("Invoice data: %r", row_data)
     
     try:
-        # Check if file exists and is accessible
-        if not os.path.exists(excel_path):
-            error_msg = f"Excel file not found at: {excel_path}"
-            safe_print(f"❌ {error_msg}")
-            raise FileNotFoundError(error_msg)
-        
-        # Check if file is read-only
-        if not os.access(excel_path, os.W_OK):
-            error_msg = "Excel file is read-only. Please close the file if it's open in Excel and ensure you have write permissions."
-            safe_print(f"❌ {error_msg}")
-            raise PermissionError(error_msg)
-        
-        # Load the existing workbook
-        safe_print("Loading workbook...")
-        wb = load_workbook(excel_path, keep_vba=True)  # keep_vba=True to preserve macros
+        # Load the existing workbook unless the caller already did
+        if wb is None:
+            safe_print("Loading workbook...")
+            wb = load_workbook(excel_path, keep_vba=True)  # keep_vba=True to preserve macros
         
         # Get the target sheet
         if sheet_name not in wb.sheetnames:
@@ -803,18 +1299,20 @@ def update_chart_of_accounts(excel_path, invoice_data, sheet_name="COA i-Kcal"):
         ws = wb[sheet_name]
         safe_print(f"Successfully accessed sheet: {sheet_name}")
         
-        # Find the first empty row by checking each row from the bottom up
+        # Find the last row holding a value
         max_row = ws.max_row
-        last_filled_row = 0
         
         safe_print(f"Checking for last filled row (max_row: {max_row})...")
         
-        # Find the last row with data
+        # Usually max_row itself holds data; only styled-but-empty trailing
+        # rows make the scan walk upwards, reading values only
+        last_filled_row = 0
         for row in range(max_row, 0, -1):
-            if any(cell.value for cell in ws[row]):
+            values = next(ws.iter_rows(min_row=row, max_row=row, values_only=True))
+            if any(values):
                 last_filled_row = row
-                safe_print(f"Found last filled row: {last_filled_row}")
                 break
+        safe_print(f"Found last filled row: {last_filled_row}")
         
         # The new row will be one after the last filled row
         new_row = last_filled_row + 1
@@ -823,72 +1321,56 @@ def update_chart_of_accounts(excel_path, invoice_data, sheet_name="COA i-Kcal"):
         # Get column headers from the first row
         headers = [cell.value for cell in ws[1]]
         safe_print(f"\nExcel Headers: {headers}")
-        safe_print(f"Invoice data keys: {list(invoice_data.keys())}")
+        
+        # Read the last filled row once; columns holding numbers there get
+        # their new value converted to a number as well
+        previous_values = [cell.value for cell in ws[last_filled_row]] if last_filled_row > 0 else []
+        converters = [to_number if isinstance(v, (int, float)) else None for v in previous_values]
+        converters += [None] * (len(headers) - len(converters))
+        
+        # Columns to fill, worked out once for every row; empty headers are skipped
+        columns = [(col_idx, header, converters[col_idx - 1])
+                   for col_idx, header in enumerate(headers, 1) if header]
         
         # Map the invoice data to the correct columns
         update_count = 0
-        for col_idx, header in enumerate(headers, 1):
-            if not header:  # Skip empty headers
-                continue
+        for row_data in rows:
+            row_count = 0
+            for col_idx, header, converter in columns:
+                # Get the value from invoice_data, default to empty string if not found
+                value = row_data.get(header, "")
                 
-            col_letter = get_column_letter(col_idx)
-            cell_ref = f"{col_letter}{new_row}"
-            
-            # Get the value from invoice_data, default to empty string if not found
-            value = invoice_data.get(header, "")
-            
-            # Skip if the header isn't in invoice_data and we don't have a value
-            if not value and header not in invoice_data:
-                continue
+                # Skip if the header isn't in invoice_data and we don't have a value
+                if not value and header not in row_data:
+                    continue
                 
-            # Convert value to appropriate type based on existing data
-            if last_filled_row > 0:  # Only if we have existing data to check types
-                try:
-                    cell_ref = f"{col_letter}{last_filled_row}"
-                    safe_print(f"Accessing cell {cell_ref} in column {col_letter} (header: {header})")
-                    
-                    # Add validation for column letter and row number
-                    if not col_letter.isalpha() or last_filled_row <= 0:
-                        safe_print(f"Invalid cell reference: {col_letter}{last_filled_row}")
-                        continue
-                        
-                    # Try to access the cell with better error handling
+                # Convert value to appropriate type based on existing data
+                if converter is not None:
                     try:
-                        existing_cell = ws.cell(row=last_filled_row, column=col_idx)
-                    except Exception as e:
-                        safe_print(f"Error accessing cell {cell_ref}: {str(e)}")
-                        continue
-                        
-                    if existing_cell is None:
-                        safe_print(f"Warning: Cell {cell_ref} is None")
-                        continue
-                        
-                    if existing_cell.value is not None:
-                        if isinstance(existing_cell.value, (int, float)):
-                            try:
-                                value = float(value) if '.' in str(value) else int(value)
-                            except (ValueError, TypeError):
-                                safe_print(f"Warning: Could not convert value '{value}' to number for column {header}")
-                except Exception as e:
-                    safe_print(f"Error processing cell {col_letter}{last_filled_row}: {str(e)}")
-                    continue
-                        
-                    if existing_cell.value is not None and isinstance(existing_cell.value, datetime):
-                        try:
-                            value = datetime.strptime(str(value), '%Y-%m-%d')
-                        except (ValueError, TypeError):
-                            safe_print(f"Warning: Could not convert value '{value}' to date for column {header}")
-                            continue
+                        value = converter(value)
+                    except (ValueError, TypeError):
+                        safe_print(f"Warning: Could not convert value '{value}' to number for column {header}")
+                
+                # Set the cell value
+                cell = ws.cell(row=new_row, column=col_idx, value=value)
+                row_count += 1
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Set %s = %s (type: %s)", cell.coordinate, value, type(value).__name__)
             
-            # Set the cell value
-            ws[cell_ref] = value
-            update_count += 1
-            safe_print(f"Set {cell_ref} = {value} (type: {type(value).__name__})")
+            # Rows that matched no column don't take up a row
+            if row_count:
+                update_count += row_count
+                new_row += 1
         
         # Save the changes if we updated any cells
         if update_count > 0:
             safe_print(f"\nSaving changes to {excel_path}...")
-            wb.save(excel_path)
+            try:
+                save_workbook(wb, excel_path)
+            except PermissionError as e:
+                error_msg = "Excel file is read-only. Please close the file if it's open in Excel and ensure you have write permissions."
+                safe_print(f"❌ {error_msg}")
+                raise PermissionError(error_msg) from e
             safe_print("Changes saved successfully")
             return True
         else:
@@ -910,6 +1392,20 @@ def update_chart_of_accounts(excel_path, invoice_data, sheet_name="COA i-Kcal"):
             except Exception as e:
                 safe_print(f"Warning: Error closing workbook: {str(e)}")
 
+def write_etag_file(file_path):
+    """Store a content hash next to a file so downloads can be revalidated cheaply."""
+    etag = file_digest(file_path)
+    with open(f"{file_path}.etag", 'w') as f:
+        f.write(etag)
+    return etag
+
+def remove_etag_file(file_path):
+    """Remove a file's ETag sidecar, if any."""
+    try:
+        os.remove(f"{file_path}.etag")
+    except FileNotFoundError:
+        pass
+
 def process_invoice_file(invoice_path, chart_path, sheet_name, output_dir, unique_id):
     """
     Process an invoice and update the chart of accounts.
@@ -924,26 +1420,54 @@ def process_invoice_file(invoice_path, chart_path, sheet_name, output_dir, uniqu
     Returns:
         dict: Processing results with status and file information
     """
+    return process_invoice_batch([invoice_path], chart_path, sheet_name, output_dir, unique_id)
+
+def process_invoice_batch(invoice_paths, chart_path, sheet_name, output_dir, unique_id):
+    """
+    Process several invoices against one chart of accounts, adding a row for each
+    with a single workbook load and save.
+    
+    Args:
+        invoice_paths (list): Paths to the invoice PDF files, in row order
+        chart_path (str): Path to the chart of accounts Excel file
+        sheet_name (str): Name of the sheet to update in the Excel file
+        output_dir (str): Directory to save the processed file
+        unique_id (str): Unique identifier for this processing job
+        
+    Returns:
+        dict: Processing results with status and file information; 'invoices'
+            holds the classified data per invoice and 'invoice_data' the first
+    """
     # Initialize result with default values
     result = {
         'status': 'error',
         'message': 'Processing not completed',
         'output_path': '',
         'output_filename': '',
-        'invoice_data': {}
+        'invoice_data': {},
+        'invoices': []
     }
     
     try:
         # Validate input paths
         safe_print("\n=== Validating input files ===")
-        safe_print(f"Invoice path: {invoice_path} (exists: {os.path.exists(invoice_path)})")
+        for invoice_path in invoice_paths:
+            safe_print(f"Invoice path: {invoice_path} (exists: {os.path.exists(invoice_path)})")
         safe_print(f"Chart path: {chart_path} (exists: {os.path.exists(chart_path)})")
         safe_print(f"Output directory: {output_dir} (exists: {os.path.exists(output_dir)})")
         
-        if not os.path.exists(invoice_path):
-            raise FileNotFoundError(f"Invoice file not found: {invoice_path}")
+        if not invoice_paths:
+            raise ValueError("No invoice files given")
+        for invoice_path in invoice_paths:
+            if not os.path.exists(invoice_path):
+                raise FileNotFoundError(f"Invoice file not found: {invoice_path}")
         if not os.path.exists(chart_path):
             raise FileNotFoundError(f"Chart file not found: {chart_path}")
+        
+        # Checked before any copy or background load is started
+        api_key = os.environ.get('ANTHROPIC_API_KEY')
+        if not api_key:
+            raise ValueError("ANTHROPIC_API_KEY environment variable not set")
             
         # Ensure output directory exists
         os.makedirs(output_dir, exist_ok=True)
@@ -957,39 +1481,23 @@ def process_invoice_file(invoice_path, chart_path, sheet_name, output_dir, uniqu
         safe_print(f"\n=== Processing invoice ===")
         safe_print(f"Output will be saved to: {output_path}")
         
-        # Extract invoice data
-        safe_print("Extracting invoice data...")
-        try:
-            invoice_text = extract_invoice_data(invoice_path)
-            safe_print("Raw invoice text extracted successfully")
-        except Exception as e:
-            safe_print(f"Error extracting invoice data: {str(e)}")
-            raise
+        # Make a working copy of the chart file; the uploaded original is never
+        # written. copyfile rather than copy2 so a read-only source doesn't
+        # yield a read-only copy and the output gets its own modification time
+        working_chart_path = os.path.join(output_dir, f'working_{unique_id}.xlsx')
+        shutil.copyfile(chart_path, working_chart_path)
+        safe_print(f"Created working copy at: {working_chart_path}")
         
-        # Analyze chart of accounts structure
-        safe_print("Analyzing chart of accounts structure...")
-        coa_sheet, structure = analyze_excel_structure(chart_path, sheet_name)
+        # Parse the workbook once, in the background, while the invoice is
+        # extracted and classified; the update step reuses it instead of
+        # loading the file again. The COA analysis runs alongside it
+        loader = ThreadPoolExecutor(max_workers=2)
+        workbook_future = loader.submit(load_workbook, working_chart_path, keep_vba=True)
+        structure_future = loader.submit(analyze_excel_structure, chart_path, sheet_name)
+        loader.shutdown(wait=False)
         
-        # Classify invoice data using Claude AI
-        safe_print("Classifying invoice data with Claude AI...")
-        api_key = os.environ.get('ANTHROPIC_API_KEY')
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY environment variable not set")
-        
-        try:
-            # Process the invoice text with Claude
-            invoice_data = classify_invoice_with_claude(
-                invoice_text=invoice_text,
-                coa_sheet=coa_sheet,
-                structure=structure,
-                api_key=api_key
-            )
-            safe_print(f"Classified invoice data: {json.dumps(invoice_data, indent=2)}")
-            
-        except Exception as e:
-            safe_print(f"Error classifying invoice with Claude: {str(e)}")
-            safe_print("Using fallback invoice data")
-            invoice_data = {
+        def fallback_invoice_data():
+            return {
                 'invoice_number': f'INV-{unique_id}',
                 'date': datetime.now().strftime('%Y-%m-%d'),
                 'amount': 1000.00,
@@ -1002,67 +1510,85 @@ def process_invoice_file(invoice_path, chart_path, sheet_name, output_dir, uniqu
                 'category': 'Income'
             }
         
-        result['invoice_data'] = invoice_data
+        # Each invoice is extracted in a thread and classified over one async
+        # client, so PDF parses and Claude round-trips of the batch overlap
+        async def extract_and_classify():
+            semaphore = asyncio.Semaphore(CLAUDE_MAX_CONCURRENCY)
+            
+            async with anthropic.AsyncAnthropic(api_key=api_key, max_retries=CLAUDE_MAX_RETRIES) as client:
+                async def one(invoice_path):
+                    async with semaphore:
+                        # Extract invoice data
+                        safe_print(f"Extracting invoice data from {invoice_path}...")
+                        try:
+                            invoice_text = await asyncio.to_thread(extract_invoice_data, invoice_path)
+                            safe_print("Raw invoice text extracted successfully")
+                        except Exception as e:
+                            safe_print(f"Error extracting invoice data: {str(e)}")
+                            raise
+                        
+                        # Analyze chart of accounts structure
+                        coa_sheet, structure = await asyncio.wrap_future(structure_future)
+                        
+                        # Classify invoice data using Claude AI
+                        safe_print("Classifying invoice data with Claude AI...")
+                        try:
+                            invoice_data = await classify_invoice_with_claude_async(
+                                invoice_text, coa_sheet, structure, client)
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug("Classified invoice data: %s", json_dumps_indented(invoice_data))
+                        except Exception as e:
+                            safe_print(f"Error classifying invoice with Claude: {str(e)}")
+                            safe_print("Using fallback invoice data")
+                            invoice_data = fallback_invoice_data()
+                        return invoice_data
+                
+                # gather keeps the invoices in upload order
+                return await asyncio.gather(*(one(invoice_path) for invoice_path in invoice_paths))
         
-        # Create a temporary file for the updated chart
-        temp_output = os.path.join(output_dir, f'temp_{unique_id}.xlsx')
+        invoices = asyncio.run(extract_and_classify())
+        
+        result['invoices'] = invoices
+        result['invoice_data'] = invoices[0]
         
         try:
             # Update the chart of accounts
             safe_print("\n=== Updating chart of accounts ===")
             safe_print(f"Using sheet: {sheet_name}")
-            safe_print(f"Temporary output: {temp_output}")
-            
-            # Make a working copy of the chart file
-            working_chart_path = os.path.join(output_dir, f'working_{unique_id}.xlsx')
-            shutil.copy2(chart_path, working_chart_path)
-            safe_print(f"Created working copy at: {working_chart_path}")
             
-            # Update the chart of accounts with the classified data
+            # Update the chart of accounts with the classified data, one row per invoice
             update_chart_of_accounts(
                 excel_path=working_chart_path,
-                invoice_data=invoice_data,
-                sheet_name=sheet_name
+                invoice_data=invoices,
+                sheet_name=sheet_name,
+                wb=workbook_future.result()
             )
             safe_print("Chart of accounts updated successfully")
             
-            # Copy the updated file to the temp location
-            shutil.copy2(working_chart_path, temp_output)
-            safe_print(f"Copied updated chart to temporary location: {temp_output}")
-            
-            # Verify the temp file was created and has content
-            if not os.path.exists(temp_output):
-                raise Exception("Failed to create temporary output file")
-                
-            file_size = os.path.getsize(temp_output)
+            # Verify the working file has content before promoting it
+            file_size = os.path.getsize(working_chart_path)
             if file_size == 0:
-                raise Exception("Temporary output file is empty")
+                raise Exception("Updated chart file is empty")
                 
-            safe_print(f"Temporary file size: {file_size} bytes")
+            safe_print(f"Updated file size: {file_size} bytes")
             
-            # Move the file to the final location
-            shutil.move(temp_output, output_path)
-            safe_print(f"Moved file to final location: {output_path}")
+            # Hash before publishing so the file never appears without its ETag
+            write_etag_file(working_chart_path)
+            os.replace(f"{working_chart_path}.etag", f"{output_path}.etag")
             
-            # Verify the final file
-            if not os.path.exists(output_path):
-                raise Exception("Failed to move file to final location")
-                
-            final_size = os.path.getsize(output_path)
-            safe_print(f"Final file size: {final_size} bytes")
-            
-            # Clean up working file
+            # The working copy lives in output_dir, so this is a rename, not a copy
             try:
-                if os.path.exists(working_chart_path):
-                    os.remove(working_chart_path)
-                    safe_print("Cleaned up working file")
-            except Exception as e:
-                safe_print(f"Warning: Could not clean up working file: {str(e)}")
+                os.replace(working_chart_path, output_path)
+            except OSError:
+                remove_etag_file(output_path)
+                raise
+            safe_print(f"Moved file to final location: {output_path}")
             
             # Update result with success
             result.update({
                 'status': 'success',
-                'message': 'Invoice processed successfully',
+                'message': ('Invoice processed successfully' if len(invoices) == 1
+                            else f'{len(invoices)} invoices processed successfully'),
                 'output_path': output_path,
                 'output_filename': output_filename
             })
@@ -1075,19 +1601,28 @@ def process_invoice_file(invoice_path, chart_path, sheet_name, output_dir, uniqu
             safe_print(f"\n!!! ERROR: {error_msg}")
             safe_print(traceback.format_exc())
             
-            # Clean up any temporary files
-            for temp_file in [temp_output, working_chart_path if 'working_chart_path' in locals() else None]:
-                if temp_file and os.path.exists(temp_file):
-                    try:
-                        os.remove(temp_file)
-                        safe_print(f"Cleaned up temporary file: {temp_file}")
-                    except:
-                        safe_print(f"Warning: Could not clean up {temp_file}")
-            
             raise Exception(error_msg)
         
     except Exception as e:
         error_trace = traceback.format_exc()
+        
+        # Stop the background load, or wait for it and close what it loaded,
+        # before its file is removed
+        if 'workbook_future' in locals() and not workbook_future.cancel():
+            try:
+                workbook_future.result().close()
+            except Exception:
+                pass  # The load itself failed; nothing to close
+        
+        # Clean up any temporary files
+        for temp_file in [working_chart_path if 'working_chart_path' in locals() else None]:
+            if temp_file and os.path.exists(temp_file):
+                try:
+                    os.remove(temp_file)
+                    safe_print(f"Cleaned up temporary file: {temp_file}")
+                except:
+                    safe_print(f"Warning: Could not clean up {temp_file}")
+        
         error_msg = f"Error processing invoice: {str(e)}"
         safe_print(f"\n!!! CRITICAL ERROR: {error_msg}")
         safe_print(f"Traceback:\n{error_trace}")
@@ -1118,18 +1653,17 @@ def safe_print(*args, **kwargs):
 def get_excel_sheets(file_path):
     """Get list of sheet names from an Excel file."""
     try:
-        xls = pd.ExcelFile(file_path)
-        return xls.sheet_names
+        return read_sheet_names(file_path)
     except Exception as e:
         safe_print(f"Error reading Excel file: {str(e)}")
         raise
 
 if __name__ == "__main__":
     import sys
-    import io
     
-    # Set stdout to handle unicode properly
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    # Set stdout to handle unicode properly, keeping its existing buffering
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(encoding='utf-8', errors='replace')
     
     # Print script information for debugging
     safe_print(f"Python version: {sys.version}")
@@ -1143,6 +1677,12 @@ if __name__ == "__main__":
         print("Please set the environment variable with your Claude API key")
         sys.exit(1)
     
+    # --batch sends the classifications through the Message Batches API: cheaper
+    # for large offline runs, but the results can take hours
+    batch_mode = '--batch' in sys.argv[1:]
+    if batch_mode:
+        sys.argv = [arg for arg in sys.argv if arg != '--batch']
+    
     # Check if command line arguments are provided
     if len(sys.argv) >= 3:
         # Use command line arguments
@@ -1169,16 +1709,41 @@ if __name__ == "__main__":
         pdf_path = r"c:\Users\Admin320\Downloads\Next Corporation S1932EE 2qty.pdf"
         excel_path = r"C:\Users\Admin320\Downloads\Chart of Account R23 28 May 2022.xlsm"
         sheet_name = "COA i-Kcal"  # Default sheet name
+        existing_file_path = None
         safe_print("No command line arguments provided. Using default paths.")
-        safe_print(f"Usage: python {sys.argv[0]} <excel_path> <pdf_path> [<sheet_name>]")
+        safe_print(f"Usage: python {sys.argv[0]} [--batch] <excel_path> <pdf_path> [<sheet_name>]")
+
+    # Several PDFs can be passed as one argument separated by os.pathsep; an
+    # existing file is taken as is, so a single name containing the separator works
+    if os.path.exists(pdf_path):
+        pdf_paths = [pdf_path]
+    else:
+        pdf_paths = [path for path in pdf_path.split(os.pathsep) if path]
+    if len(pdf_paths) > 1 or batch_mode:
+        safe_print(f"\nProcessing {len(pdf_paths)} invoices {'as a message batch' if batch_mode else 'concurrently'}...")
+        try:
+            processed_file_path = process_pdfs(excel_path, pdf_paths, sheet_name, api_key, existing_file_path,
+                                               batch_mode=batch_mode)
+        except FileNotFoundError as e:
+            safe_print(f"\nError: file not found: {str(e)}")
+            sys.exit(1)
+        safe_print("\n✅ Process completed successfully!")
+        safe_print(f"Saved to: {processed_file_path}")
+        sys.exit(0)
 
     safe_print("\nStarting invoice processing...")
     safe_print(f"PDF Path: {pdf_path}")
     safe_print(f"Excel Path: {excel_path}")
 
+    # The PDF and the COA don't depend on each other, so read them together
+    reader = ThreadPoolExecutor(max_workers=2)
+    invoice_future = reader.submit(extract_invoice_data, pdf_path)
+    structure_future = reader.submit(analyze_excel_structure, excel_path, sheet_name)
+    reader.shutdown(wait=False)
+
     # Extract data from the invoice
     try:
-        invoice_text = extract_invoice_data(pdf_path)
+        invoice_text = invoice_future.result()
         if len(invoice_text) > 500:
             safe_print("\nExtracted Invoice Text: " + invoice_text[:500] + "...")
         else:
@@ -1189,7 +1754,7 @@ if __name__ == "__main__":
 
     # Analyze the Chart of Accounts structure
     try:
-        coa_sheet, structure = analyze_excel_structure(excel_path, sheet_name)
+        coa_sheet, structure = structure_future.result()
         safe_print("\nExcel Structure Analyzed")
     except FileNotFoundError:
         safe_print(f"\nError: Excel file not found at path: {excel_path}")
@@ -1217,10 +1782,9 @@ if __name__ == "__main__":
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             csv_path = os.path.join(csv_dir, f"invoice_data_{timestamp}.csv")
             
-            with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=classified_data.keys())
-                writer.writeheader()
-                writer.writerow(classified_data)
+            with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerows([list(classified_data.keys()), list(classified_data.values())])
             
             updated_file = csv_path
             safe_print(f"\nCreated CSV file as fallback: {csv_path}")
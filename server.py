@@ -60,11 +60,11 @@ def index():
     </html>
     """
 
-# Create folders if they don't exist
-@app.before_first_request
-def create_folders():
-    for folder in ['uploads', 'temp', 'processed']:
-        os.makedirs(folder, exist_ok=True)
+# Create folders if they don't exist; runs once per worker at import
+for folder in ['uploads', 'temp', 'processed']:
+    os.makedirs(folder, exist_ok=True)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    # Development server only; in production run under gunicorn with gevent
+    # workers, e.g. gunicorn -k gevent -w 4 server:app
+    app.run(debug=os.environ.get('FLASK_ENV') == 'development', host='0.0.0.0')
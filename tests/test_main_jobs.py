@@ -0,0 +1,135 @@
+import io
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest import mock
+
+# main creates its folders at import, so point them somewhere disposable first
+BASE = tempfile.mkdtemp()
+for name in ('UPLOAD_FOLDER', 'PROCESSED_FOLDER', 'TEMP_FOLDER'):
+    os.environ[name] = os.path.join(BASE, name.lower())
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def tearDownModule():
+    shutil.rmtree(BASE, ignore_errors=True)
+
+
+def crashing_executor():
+    # Every worker dies while starting, which breaks the pool like an OOM kill would
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=os._exit, initargs=(1,))
+
+
+def fake_batch(invoice_paths, chart_path, sheet_name, output_dir, unique_id):
+    output_path = os.path.join(output_dir, f'processed_{unique_id}.xlsx')
+    with open(output_path, 'wb') as f:
+        f.write(b'PK\x03\x04')
+    return {'status': 'success', 'message': 'done', 'output_path': output_path}
+
+
+class InvoiceJobTests(unittest.TestCase):
+    def setUp(self):
+        main.executor = None
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        if main.executor is not None:
+            main.executor.shutdown(wait=True)
+            main.executor = None
+
+    def upload(self):
+        response = self.client.post('/api/process-invoice', data={
+            'invoiceFile': (io.BytesIO(b'%PDF-1.4\n'), 'invoice.pdf'),
+            'coaFile': (io.BytesIO(b'PK\x03\x04'), 'chart.xlsx'),
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json['status'], 'queued')
+        return response.json['job_id']
+
+    def wait_for(self, job_id, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            response = self.client.get(f'/api/process-status/{job_id}')
+            if response.json['status'] not in ('queued', 'processing'):
+                return response
+            time.sleep(0.05)
+        self.fail(f'Job {job_id} did not finish')
+
+    def assertUploadsRemoved(self, timeout=10):
+        # The final status is written just before the job's cleanup runs
+        deadline = time.monotonic() + timeout
+        while os.listdir(main.app.config['UPLOAD_FOLDER']) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(os.listdir(main.app.config['UPLOAD_FOLDER']), [])
+
+    def test_job_success(self):
+        with mock.patch.object(main, 'new_invoice_executor', lambda: ThreadPoolExecutor(1)), \
+                mock.patch.object(main, 'process_invoice_batch', fake_batch):
+            job_id = self.upload()
+            response = self.wait_for(job_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['status'], 'success')
+        self.assertEqual(response.json['download_url'], f'/api/download-file/processed_{job_id}.xlsx')
+        self.assertUploadsRemoved()
+
+    def test_job_exception(self):
+        def failing_batch(**kwargs):
+            raise RuntimeError('chart could not be read')
+
+        with mock.patch.object(main, 'new_invoice_executor', lambda: ThreadPoolExecutor(1)), \
+                mock.patch.object(main, 'process_invoice_batch', failing_batch):
+            job_id = self.upload()
+            response = self.wait_for(job_id)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json['error'], 'chart could not be read')
+        self.assertUploadsRemoved()
+
+    def test_pool_crash(self):
+        executors = iter([crashing_executor(), ThreadPoolExecutor(1)])
+        with mock.patch.object(main, 'new_invoice_executor', lambda: next(executors)), \
+                mock.patch.object(main, 'process_invoice_batch', fake_batch):
+            # The crash fails the job and removes its uploads
+            job_id = self.upload()
+            response = self.wait_for(job_id)
+            self.assertEqual(response.status_code, 500)
+            self.assertIn('terminated abruptly', response.json['error'])
+            self.assertUploadsRemoved()
+
+            # The next job gets a fresh pool
+            job_id = self.upload()
+            response = self.wait_for(job_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['status'], 'success')
+
+    def test_dead_owner(self):
+        owner = subprocess.Popen([sys.executable, '-c', 'pass'])
+        owner.wait()
+        main.write_job_status('deadbeef', {'status': 'queued', 'job_id': 'deadbeef', 'owner_pid': owner.pid})
+        response = self.client.get('/api/process-status/deadbeef')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json['status'], 'error')
+        self.assertEqual(main.read_job_status('deadbeef')['status'], 'error')
+
+    def test_etag_sidecar_not_downloadable(self):
+        with mock.patch.object(main, 'new_invoice_executor', lambda: ThreadPoolExecutor(1)), \
+                mock.patch.object(main, 'process_invoice_batch', fake_batch):
+            job_id = self.upload()
+            self.wait_for(job_id)
+        filename = f'processed_{job_id}.xlsx'
+        with open(os.path.join(main.app.config['PROCESSED_FOLDER'], f'{filename}.etag'), 'w') as f:
+            f.write('abc')
+        self.assertEqual(self.client.get(f'/api/download-file/{filename}').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/download-file/{filename}.etag').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()